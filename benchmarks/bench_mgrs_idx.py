@@ -0,0 +1,20 @@
+import time
+from geoquery.MGRSIndex import CalcMGRSIdx, MGRSIdxFromArrays, ReadMGRSIdx, MGRS_IDX_FILE
+
+# Compares building the MGRS index from scratch (the old adapter startup
+# cost) with loading the packaged index file.
+
+start = time.perf_counter()
+calc_idx = CalcMGRSIdx()
+calc_time = time.perf_counter() - start
+
+start = time.perf_counter()
+arrays = ReadMGRSIdx(MGRS_IDX_FILE)
+if arrays is None:
+    raise RuntimeError(f'{MGRS_IDX_FILE} is stale, run get_mgrs_idx.py')
+load_idx = MGRSIdxFromArrays(arrays)
+load_time = time.perf_counter() - start
+
+print(f'CalcMGRSIdx: {calc_time:.3f}s')
+print(f'packaged index load: {load_time:.3f}s')
+print(f'match: {calc_idx == load_idx}')
@@ -0,0 +1,299 @@
+import argparse
+import statistics
+import subprocess
+import tracemalloc
+import shutil
+import json
+import time
+import sys
+import os
+import numpy as np
+from osgeo import gdal
+import geoquery
+from geoquery import EarthDataAdapter, SentinelAdapter, SentinelMirrorBackend
+from geoquery.Raster import GetSRCoord
+from fixtures import (TileGrid, TileOrigin, UTMToLonLat, UTMProjection, HLSDates, MakeHLSArchive, RemoveProjections,
+                      MakeSentinelMirror)
+
+# Times the query hot paths on synthetic HLS and Sentinel archives, offline.
+#
+# Results are named `<adapter>.<stage>.<scenario>...`. Timings are in seconds,
+# the median of --repeat runs. `peak_bytes` is the peak of Python and numpy
+# allocations while a warm result is built, and `products` the number of
+# products a query mosaics. Cold builds start from a fixture without
+# reprojected products or catalogs. HLS queries ask for --resolution rather
+# than the fixture's pixel size, so cold builds warp every product and warm
+# builds reuse them; a run fails otherwise. Sentinel queries ask for
+# SENTINEL_RESOLUTION meters in the UTM zone of the fixture. A run also fails
+# if a result is empty or not the size of its query grid. With --output, results are saved
+# as JSON together with the commit they were measured at; --compare reads such
+# a file and exits with status 1 if a result grew by more than --threshold.
+
+ORIGIN_TILE = '10TDS'
+# Sentinel fixtures are in EPSG:4326 and queried on a projected grid of this many meters.
+SENTINEL_RESOLUTION = 100
+
+# Statements whose import time is measured, each in a fresh interpreter.
+IMPORT_CASES = {'geoquery': 'import geoquery', 'earthdata': 'from geoquery import EarthDataAdapter',
+                'sentinel': 'from geoquery import SentinelAdapter', 'interface': 'from geoquery import GeoInterface'}
+# Modules that only the adapters need; `import geoquery` must not load them.
+DEFERRED_MODULES = ('osgeo', 'numpy', 'mgrs', 'dateutil', 'requests', 'sentinelsat', 'osfclient', 'geojson')
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': [name for name in sys.argv[2:] if name in sys.modules]}))
+'''
+
+def Time(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return(time.perf_counter() - start, result)
+
+def PeakBytes(fn, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        return(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+def Median(samples):
+    return(statistics.median(samples))
+
+def CheckResult(name, results, lon1, lat1, lon2, lat2, projection, resolution):
+    """Raises RuntimeError unless `results` holds at least one array, each of the query grid's shape and with some valid data."""
+    lb = GetSRCoord(lon1, lat1, projection)
+    ub = GetSRCoord(lon2, lat2, projection)
+    shape = (int(abs(lb[1] - ub[1]) / resolution), int(abs(lb[0] - ub[0]) / resolution))
+    if not results:
+        raise RuntimeError(f'{name}: the query returned no results')
+    for key, result in results.items():
+        if result.shape != shape:
+            raise RuntimeError(f'{name}: {key} has shape {result.shape}, expected {shape}')
+        # Pixels no product covers hold 0 in HLS results and NaN in Sentinel ones.
+        if not np.any(np.nan_to_num(result) != 0):
+            raise RuntimeError(f'{name}: {key} holds no data')
+
+def TileBox(tile, x0, y0, x1, y1):
+    """Returns (lon1, lat1, lon2, lat2) of the box from (x0, y0) to (x1, y1), in meters from the south-west corner of `tile`."""
+    zone, hemisphere, easting, northing = TileOrigin(tile)
+    lon1, lat1 = UTMToLonLat(zone, hemisphere, easting + x0, northing + y0)
+    lon2, lat2 = UTMToLonLat(zone, hemisphere, easting + x1, northing + y1)
+    return(lon1, lat1, lon2, lat2)
+
+def HLSScenarios(tiles, columns, dates):
+    """Returns [(name, target, box, edate)]: AOI sizes inside one tile, AOIs spanning more tiles, and more dates."""
+    center = tiles[(columns // 2) * columns + columns // 2]
+    last = HLSDates(dates)[-1].strftime('%Y%m%d')
+    scenarios = []
+    for side in (5000, 20000, 80000):
+        box = TileBox(center, 50000 - side / 2, 50000 - side / 2, 50000 + side / 2, 50000 + side / 2)
+        scenarios.append((f'aoi-{side // 1000}km', 'hls', box, last))
+    for span in range(1, columns + 1):
+        # From the middle of the south-west tile to the middle of the tile `span - 1` tiles up and right of it.
+        reach = 100000 * (span - 1) + 20000
+        scenarios.append((f'tiles-{span * span}', 'hls', TileBox(tiles[0], 40000, 40000, 40000 + reach, 40000 + reach), last))
+    count = 1
+    while True:
+        edate = HLSDates(count)[-1].strftime('%Y%m%d')
+        scenarios.append((f'dates-{count}', 'hls^dates=all', TileBox(center, 40000, 40000, 60000, 60000), edate))
+        if count >= dates:
+            break
+        count = min(dates, count * 2)
+    return(scenarios)
+
+def ImportTime(statement):
+    """Runs `statement` in a new interpreter importing this checkout's geoquery, returning (seconds, deferred modules it loaded)."""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(geoquery.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT, statement, *DEFERRED_MODULES], env = env,
+                            capture_output = True, text = True, check = True).stdout
+    run = json.loads(output)
+    return(run['seconds'], run['modules'])
+
+def BenchImport(args, results):
+    """Times the import of the package and of each adapter, and returns the problems found with `import geoquery`."""
+    problems = []
+    deferred = []
+    for name, statement in IMPORT_CASES.items():
+        samples = []
+        try:
+            for i in range(args.repeat):
+                seconds, modules = ImportTime(statement)
+                samples.append(seconds)
+        except subprocess.CalledProcessError as e:
+            problems.append(f'{statement} failed: {e.stderr.strip().splitlines()[-1]}')
+            continue
+        results[f'import.{name}.seconds'] = Median(samples)
+        if name == 'geoquery':
+            deferred = modules
+            results['import.geoquery.deferred_modules'] = len(modules)
+    if deferred:
+        problems.append(f'import geoquery loaded {", ".join(deferred)}')
+    if results.get('import.geoquery.seconds', 0) > args.import_budget:
+        problems.append(f'import geoquery took {results["import.geoquery.seconds"]:.3f}s, over the {args.import_budget}s budget')
+    return(problems)
+
+def BenchHLS(args, results):
+    tiles = TileGrid(ORIGIN_TILE, args.columns, args.columns)
+    directory = f'{args.fixtures}/hls-{args.columns}x{args.columns}-{args.dates}d-{args.pixel}m'
+    MakeHLSArchive(directory, tiles, args.dates, pixel = args.pixel)
+    zone, hemisphere, ignored, ignored = TileOrigin(ORIGIN_TILE)
+    projection = UTMProjection(zone, hemisphere)
+    # Queries on the fixture's own grid would read the native files, and never warp.
+    resolution = args.resolution or 2 * args.pixel
+    if resolution == args.pixel:
+        raise ValueError('--resolution must differ from --pixel, or cold builds do not warp')
+    sdate = HLSDates(1)[0].strftime('%Y%m%d')
+
+    cold = []
+    warm = []
+    for i in range(args.repeat):
+        RemoveProjections(directory)
+        cold.append(Time(EarthDataAdapter, directory)[0])
+        warm.append(Time(EarthDataAdapter, directory)[0])
+    results['hls.construct.cold'] = Median(cold)
+    results['hls.construct.warm'] = Median(warm)
+
+    for name, target, (lon1, lat1, lon2, lat2), edate in HLSScenarios(tiles, args.columns, args.dates):
+        resolve = []
+        cold = []
+        warm = []
+        for i in range(args.repeat):
+            RemoveProjections(directory)
+            adapter = EarthDataAdapter(directory, workers = args.workers)
+            seconds, products = Time(lambda: adapter.CreateQuery(target, lon1, lat1, lon2, lat2, sdate, edate).GetProductList())
+            resolve.append(seconds)
+            misses = adapter.cache.misses
+            seconds, result = Time(adapter.BuildResult, products, lon1, lat1, lon2, lat2, projection, resolution)
+            cold.append(seconds)
+            CheckResult(f'hls {name}', result, lon1, lat1, lon2, lat2, projection, resolution)
+            warped = adapter.cache.misses - misses
+            seconds, result = Time(adapter.BuildResult, products, lon1, lat1, lon2, lat2, projection, resolution)
+            warm.append(seconds)
+            CheckResult(f'hls {name}', result, lon1, lat1, lon2, lat2, projection, resolution)
+            # The cold build must warp every product, and the warm one reuse them all.
+            if warped == 0 or adapter.cache.misses - misses != warped:
+                raise RuntimeError(f'hls {name}: cold build warped {warped} products, warm build {adapter.cache.misses - misses - warped}')
+        results[f'hls.resolve.{name}'] = Median(resolve)
+        results[f'hls.build.{name}.cold'] = Median(cold)
+        results[f'hls.build.{name}.warm'] = Median(warm)
+        results[f'hls.build.{name}.peak_bytes'] = PeakBytes(adapter.BuildResult, products, lon1, lat1, lon2, lat2, projection, resolution)
+        results[f'hls.build.{name}.products'] = len(products['results'])
+
+def BenchSentinel(args, results):
+    zone, hemisphere, easting, northing = TileOrigin(ORIGIN_TILE)
+    lon, lat = UTMToLonLat(zone, hemisphere, easting + 50000, northing + 50000)
+    spacing = 0.0005
+    directory = os.path.abspath(f'{args.fixtures}/sentinel-{args.products}')
+    products = MakeSentinelMirror(f'{directory}/mirror', lon, lat, args.products, spacing = spacing)
+    extent = 1000 * spacing
+    lon1, lat1, lon2, lat2 = lon + extent / 4, lat - 3 * extent / 4, lon + 3 * extent / 4, lat - extent / 4
+    query_results = {'products': products, 'bands': None, 'polarities': None, 'extract': 'selected'}
+    # A projected grid, as for HLS: in EPSG:4326 GetSRCoord() returns (lat, lon), and the window would miss the fixture.
+    projection = UTMProjection(zone, hemisphere)
+    resolution = SENTINEL_RESOLUTION
+    # SentinelAdapter keeps its archives, extracted measurements and cache in the working directory.
+    cwd = os.getcwd()
+    fetch = []
+    cold = []
+    warm = []
+    try:
+        for i in range(args.repeat):
+            shutil.rmtree(f'{directory}/work', ignore_errors = True)
+            os.makedirs(f'{directory}/work')
+            os.chdir(f'{directory}/work')
+            adapter = SentinelAdapter(catalog = ':memory:', backend = SentinelMirrorBackend(f'{directory}/mirror'))
+            fetch.append(Time(adapter.GetProducts, query_results)[0])
+            seconds, result = Time(adapter.BuildResult, query_results, lon1, lat1, lon2, lat2, projection, resolution)
+            cold.append(seconds)
+            CheckResult('sentinel', result, lon1, lat1, lon2, lat2, projection, resolution)
+            warped = adapter.cache.misses
+            seconds, result = Time(adapter.BuildResult, query_results, lon1, lat1, lon2, lat2, projection, resolution)
+            warm.append(seconds)
+            CheckResult('sentinel', result, lon1, lat1, lon2, lat2, projection, resolution)
+            if warped == 0 or adapter.cache.misses != warped:
+                raise RuntimeError(f'sentinel: cold build warped {warped} measurements, warm build {adapter.cache.misses - warped}')
+        results['sentinel.fetch.cold'] = Median(fetch)
+        results['sentinel.build.cold'] = Median(cold)
+        results['sentinel.build.warm'] = Median(warm)
+        results['sentinel.build.peak_bytes'] = PeakBytes(adapter.BuildResult, query_results, lon1, lat1, lon2, lat2, projection, resolution)
+    finally:
+        os.chdir(cwd)
+
+def Commit():
+    try:
+        return(subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, check = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+def Compare(results, baseline, threshold):
+    """Prints each result next to its baseline and returns the names of those that grew by more than `threshold`."""
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline['results'] or name.endswith('.products'):
+            continue
+        before = baseline['results'][name]
+        ratio = value / before if before else float('inf') if value else 1.0
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:40} {before:14.6g} -> {value:14.6g}  x{ratio:.2f}{flag}')
+    return(regressions)
+
+def Main():
+    parser = argparse.ArgumentParser(description = 'Benchmark GeoQuery adapters on synthetic archives.')
+    parser.add_argument('--fixtures', default = os.path.expanduser('~/.cache/geoquery/benchmarks'),
+                        help = 'directory the synthetic archives are generated in and reused from')
+    parser.add_argument('--adapters', default = 'import,hls,sentinel', help = 'comma-separated benchmarks to run: import, hls, sentinel')
+    parser.add_argument('--columns', type = int, default = 3, help = 'HLS fixture is columns x columns tiles')
+    parser.add_argument('--dates', type = int, default = 4, help = 'acquisitions per HLS tile')
+    parser.add_argument('--pixel', type = int, default = 120, help = 'HLS fixture pixel size, in meters')
+    parser.add_argument('--resolution', type = int, help = 'HLS query resolution in meters, by default twice --pixel')
+    parser.add_argument('--workers', type = int, default = 1, help = 'EarthDataAdapter warp workers')
+    parser.add_argument('--products', type = int, default = 2, help = 'Sentinel products in the fixture')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--output', help = 'write the results to this JSON file')
+    parser.add_argument('--compare', help = 'JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', type = float, default = 1.25, help = 'largest result ratio that is not a regression')
+    parser.add_argument('--import-budget', type = float, default = 0.2, help = 'seconds `import geoquery` may take')
+    args = parser.parse_args()
+
+    adapters = args.adapters.split(',')
+    results = {}
+    problems = []
+    if 'import' in adapters:
+        problems.extend(BenchImport(args, results))
+    if 'hls' in adapters:
+        BenchHLS(args, results)
+    if 'sentinel' in adapters:
+        BenchSentinel(args, results)
+    for name, value in results.items():
+        print(f'{name:40} {value:14.6g}')
+
+    run = {'commit': Commit(), 'python': sys.version.split()[0], 'gdal': gdal.__version__,
+           'parameters': {key: value for key, value in vars(args).items() if key not in ('fixtures', 'output', 'compare', 'threshold', 'import_budget')},
+           'results': results}
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(run, fp, indent = 2)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline['parameters'] != run['parameters']:
+            print('warning: the baseline was measured with different parameters', file = sys.stderr)
+        regressions = Compare(results, baseline, args.threshold)
+        if regressions:
+            problems.append(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+    for problem in problems:
+        print(problem, file = sys.stderr)
+    if problems:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    Main()
@@ -0,0 +1,80 @@
+import sys
+import time
+import mgrs
+import numpy as np
+from geoquery.MGRSIndex import GetMGRSIdx, GetMGRSGrid, char_range
+
+# Checks MGRSGrid.FindTiles() against the loop over the MGRS index that it
+# replaced, on random boxes and on boxes that once broke it, and compares
+# their speed, also for the small boxes alone. Exits with status 1 if they
+# disagree on any box.
+
+BOXES = 600
+# Boxes of at most SMALL_EXTENT degrees a side, the size of most queries.
+SMALL_BOXES = 600
+SMALL_EXTENT = 0.5
+SEED = 0
+# (lon1, lat1, lon2, lat2). Around Svalbard, this box starts in 32WLD and ends in 31XFE.
+KNOWN_BOXES = [(6.10, 70.35, 7.54, 76.13)]
+
+def LoopTiles(mdb, bl, tr):
+    """Returns the tiles between `bl` and `tr` the way FindIntermediateTiles did before MGRSGrid."""
+    results = []
+    bl_offset = mdb[(bl[0], bl[1])][(bl[2], bl[3])]
+    tr_offset = mdb[(tr[0], tr[1])][(tr[2], tr[3])]
+    for first in range(bl[0], tr[0] + 1):
+        for second in char_range(bl[1], tr[1]):
+            tiles = mdb.get((first, second), {})
+            for tile in tiles:
+                tile_offset = tiles[tile]
+                if (first == bl[0] and tile_offset[0] < bl_offset[0]) or (second == bl[1] and tile_offset[1] < bl_offset[1]):
+                    continue
+                elif (first == tr[0] and tile_offset[0] > tr_offset[0]) or (second == tr[1] and tile_offset[1] > tr_offset[1]):
+                    continue
+                results.append((first, second, tile[0], tile[1]))
+    return(results)
+
+def Corners(m, lon1, lat1, lon2, lat2):
+    """Returns the MGRS tuples of the corners of a box, as EarthDataBoxQuery computes them."""
+    corners = []
+    for lat, lon in ((min(lat1, lat2), min(lon1, lon2)), (max(lat1, lat2), max(lon1, lon2))):
+        tile = m.toMGRS(lat, lon, MGRSPrecision = 0)
+        corners.append((int(tile[0:2]), tile[2], tile[3], tile[4]))
+    return(corners)
+
+rng = np.random.default_rng(SEED)
+boxes = list(KNOWN_BOXES)
+for i in range(BOXES):
+    lon1 = rng.uniform(-180, 175)
+    lat1 = rng.uniform(-79, 80)
+    boxes.append((lon1, lat1, lon1 + rng.uniform(0, 5), min(lat1 + rng.uniform(0, 5), 83.9)))
+small = set()
+for i in range(SMALL_BOXES):
+    lon1 = rng.uniform(-180, 179)
+    lat1 = rng.uniform(-79, 83)
+    small.add(len(boxes))
+    boxes.append((lon1, lat1, lon1 + rng.uniform(0, SMALL_EXTENT), min(lat1 + rng.uniform(0, SMALL_EXTENT), 83.9)))
+
+m = mgrs.MGRS()
+mdb = GetMGRSIdx()
+grid = GetMGRSGrid()
+corners = [Corners(m, *box) for box in boxes]
+loop_time = [0, 0]
+grid_time = [0, 0]
+mismatches = 0
+for i, (box, (bl, tr)) in enumerate(zip(boxes, corners)):
+    start = time.perf_counter()
+    expected = LoopTiles(mdb, bl, tr)
+    loop_time[i in small] += time.perf_counter() - start
+    start = time.perf_counter()
+    found = grid.Tuples(grid.FindTiles(bl, tr))
+    grid_time[i in small] += time.perf_counter() - start
+    if sorted(found) != sorted(expected):
+        mismatches += 1
+        print(f'box {box}: FindTiles returned {len(found)} tiles, the loop {len(expected)}')
+
+print(f'{len(boxes)} boxes, {mismatches} mismatches')
+print(f'loop: {sum(loop_time):.3f}s, FindTiles: {sum(grid_time):.3f}s')
+print(f'{len(small)} small boxes: loop {loop_time[1]:.3f}s, FindTiles {grid_time[1]:.3f}s')
+if mismatches:
+    sys.exit(1)
@@ -0,0 +1,114 @@
+import numpy as np
+from osgeo import gdal, osr
+from zipfile import ZipFile
+from datetime import date, timedelta
+import mgrs
+import os
+
+# Synthetic archives for the benchmarks, so they run without Copernicus or OSF
+# access. Every fixture is generated from `seed` and its arguments alone, so
+# runs against different commits read identical data.
+
+HLS_TILE_SIZE = 109800
+HLS_FIRST_DATE = date(2023, 1, 1)
+HLS_REVISIT = 5
+FIXTURE_GTIFF_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE']
+
+def TileOrigin(tile):
+    """Returns (zone, hemisphere, easting, northing) of the south-west corner of an MGRS 100 km tile such as '10TES'."""
+    return(mgrs.MGRS().MGRSToUTM(tile))
+
+def TileGrid(origin, columns, rows):
+    """Returns the names of a `columns` x `rows` block of adjacent tiles, starting with `origin` in the south-west."""
+    m = mgrs.MGRS()
+    zone, hemisphere, easting, northing = TileOrigin(origin)
+    tiles = []
+    for row in range(rows):
+        for column in range(columns):
+            tiles.append(m.UTMToMGRS(zone, hemisphere, easting + 100000 * column + 50000, northing + 100000 * row + 50000, 0))
+    return(tiles)
+
+def UTMToLonLat(zone, hemisphere, easting, northing):
+    m = mgrs.MGRS()
+    lat, lon = m.toLatLon(m.UTMToMGRS(zone, hemisphere, easting, northing, 5))
+    return(lon, lat)
+
+def UTMProjection(zone, hemisphere):
+    return(f'EPSG:{32600 + zone if hemisphere == "N" else 32700 + zone}')
+
+def WriteRaster(path, data, projection, geotransform, nodata = None):
+    driver = gdal.GetDriverByName('GTiff')
+    dat = driver.Create(path, data.shape[1], data.shape[0], 1, gdal.GetDataTypeByName(data.dtype.name.capitalize()), FIXTURE_GTIFF_OPTIONS)
+    ref = osr.SpatialReference()
+    ref.SetFromUserInput(projection)
+    dat.SetProjection(ref.ExportToWkt())
+    dat.SetGeoTransform(geotransform)
+    band = dat.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(data)
+    dat.FlushCache()
+
+def HLSDates(count):
+    return([HLS_FIRST_DATE + timedelta(days = HLS_REVISIT * i) for i in range(count)])
+
+def MakeHLSArchive(directory, tiles, dates = 1, quantities = ('B04',), pixel = 120, seed = 0):
+    """Writes native HLS GeoTIFFs for `tiles` under `<directory>/<zone><band>/<column><row>/`, as EarthDataLocalAccess expects.
+
+    Each tile gets one file per quantity for each of `dates` acquisitions,
+    HLS_REVISIT days apart from HLS_FIRST_DATE, at `pixel` meters. Existing
+    files are kept, so a fixture directory can be reused across runs.
+    Returns the paths of the files.
+    """
+    rng = np.random.default_rng(seed)
+    size = int(HLS_TILE_SIZE / pixel)
+    paths = []
+    for tile in tiles:
+        zone, hemisphere, easting, northing = TileOrigin(tile)
+        outer = f'{directory}/{tile[0:3]}/{tile[3:5]}'
+        os.makedirs(outer, exist_ok = True)
+        for day in HLSDates(dates):
+            for quantity in quantities:
+                data = rng.integers(0, 10000, (size, size), dtype = np.int16)
+                path = f'{outer}/HLS.S30.T{tile}.{day.strftime("%Y%j")}T190000.v2.0.{quantity}.tif'
+                if not os.path.exists(path):
+                    WriteRaster(path, data, UTMProjection(zone, hemisphere), (easting, pixel, 0, northing + HLS_TILE_SIZE, 0, -pixel), -9999)
+                paths.append(path)
+    return(paths)
+
+def RemoveProjections(directory):
+    """Deletes the reprojected copies, overviews and caches an EarthDataAdapter wrote into a fixture, leaving the native files."""
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            native = file.endswith('.tif') and len(file.split('.')) == 8
+            if not native:
+                os.remove(os.path.join(root, file))
+
+def MakeSentinelMirror(directory, lon, lat, count = 1, polarities = ('vv', 'vh'), swaths = ('iw1',), size = 1000, spacing = 0.0005, seed = 0):
+    """Writes `count` fake Sentinel-1 SAFE archives, `<title>.zip`, to `directory`, for SentinelMirrorBackend.
+
+    Each archive holds one `size` x `size` float32 measurement per swath and
+    polarity, named like the real ones, whose north-west corner is at (`lon`,
+    `lat`). Returns {product: metadata} in the form SentinelBoxQuery returns.
+    """
+    os.makedirs(directory, exist_ok = True)
+    products = {}
+    for i in range(count):
+        rng = np.random.default_rng([seed, i])
+        title = f'S1A_IW_SLC__1SDV_20230101T{i:06d}_20230101T{i:06d}_046000_058000_{i:04X}'
+        path = f'{directory}/{title}.zip'
+        if not os.path.exists(path):
+            tmp_dir = f'{directory}/{title}.tmp'
+            os.makedirs(tmp_dir, exist_ok = True)
+            with ZipFile(path, 'w') as zip_ref:
+                for swath in swaths:
+                    for polarity in polarities:
+                        name = f's1a-{swath}-slc-{polarity}-20230101t{i:06d}-20230101t{i:06d}-046000-058000-001.tiff'
+                        tmp_file = f'{tmp_dir}/{name}'
+                        data = rng.random((size, size), dtype = np.float32)
+                        WriteRaster(tmp_file, data, 'EPSG:4326', (lon, spacing, 0, lat, 0, -spacing))
+                        zip_ref.write(tmp_file, f'{title}.SAFE/measurement/{name}')
+                        os.remove(tmp_file)
+            os.rmdir(tmp_dir)
+        products[f'product-{i}'] = {'title': title, 'orbitdirection': 'ASCENDING', 'size': os.path.getsize(path)}
+    return(products)
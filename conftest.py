@@ -0,0 +1,3 @@
+# examples/multisource_test.py is a command-line example that queries live
+# repositories, not a test, despite its name.
+collect_ignore = ['examples']
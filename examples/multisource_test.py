@@ -15,6 +15,6 @@ hls = EarthDataAdapter('v4uz9', provider='osf')
 geo.AddAdapter("sentinel1", sentinel)
 geo.AddAdapter("hls", hls)
 
-sentinel_result = geo.Query("sentinel1^instrument=sar,product=slc", lon1, lat1, lon2, lat2, sdate, edate, projection, res)
-hls_result = geo.Query('hls', lon1, lat1, lon2, lat2, sdate, edate, projection, res)
-
+stack, bands = geo.FusedQuery(["sentinel1^instrument=sar,product=slc", "hls"], lon1, lat1, lon2, lat2, sdate, edate, projection, res)
+for (target, key), band in zip(bands, stack):
+    print(target, key, band.shape)
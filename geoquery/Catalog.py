@@ -0,0 +1,222 @@
+import threading
+import pickle
+import json
+
+from .Storage import OpenDatabase
+
+# Bump when the catalog tables change; older catalogs are dropped and rebuilt.
+CATALOG_SCHEMA = 1
+
+class LocalCatalog:
+    """Persistent record of the GeoTIFFs under a local EarthData directory tree.
+
+    Rows are keyed by path and carry the file's mtime and size, so a caller
+    can tell which files changed since they were last read.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path, self.conn = OpenDatabase(path, self.Setup)
+
+    def Setup(self, conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOG_SCHEMA:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS files')
+                conn.execute('DROP TABLE IF EXISTS dirs')
+                conn.execute(f'PRAGMA user_version = {CATALOG_SCHEMA}')
+        with conn:
+            # `res` is declared without a type so both float (native) and string
+            # (parsed from reprojected file names) resolutions round-trip unchanged.
+            conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                                path TEXT PRIMARY KEY,
+                                mtime INTEGER NOT NULL,
+                                size INTEGER NOT NULL,
+                                var TEXT NOT NULL,
+                                tile TEXT NOT NULL,
+                                quantity TEXT NOT NULL,
+                                date TEXT NOT NULL,
+                                res,
+                                proj TEXT,
+                                native INTEGER NOT NULL)''')
+            # The listing of each directory as of the last refresh, as JSON [[name, is_dir], ...].
+            conn.execute('''CREATE TABLE IF NOT EXISTS dirs (
+                                path TEXT PRIMARY KEY,
+                                mtime INTEGER NOT NULL,
+                                entries TEXT NOT NULL)''')
+
+    def LoadTree(self):
+        """Returns ({directory: (mtime, [(name, is_dir)])}, {path: (mtime, size, var, tile, quantity, date, res, proj, native)}) from one snapshot."""
+        with self.lock:
+            # One read transaction, so the listings and the files come from the same refresh.
+            self.conn.execute('BEGIN')
+            try:
+                dirs = self.conn.execute('SELECT path, mtime, entries FROM dirs').fetchall()
+                rows = self.conn.execute('SELECT path, mtime, size, var, tile, quantity, date, res, proj, native FROM files').fetchall()
+            finally:
+                self.conn.commit()
+        return({path: (mtime, [tuple(entry) for entry in json.loads(entries)]) for path, mtime, entries in dirs},
+               {row[0]: row[1:9] + (bool(row[9]),) for row in rows})
+
+    def Load(self, paths = None):
+        """Returns {path: (mtime, size, var, tile, quantity, date, res, proj, native)} for every cataloged file, or only for `paths`."""
+        query = 'SELECT path, mtime, size, var, tile, quantity, date, res, proj, native FROM files'
+        with self.lock:
+            if paths is None:
+                rows = self.conn.execute(query).fetchall()
+            else:
+                paths = list(paths)
+                rows = []
+                for i in range(0, len(paths), 500):
+                    chunk = paths[i:i+500]
+                    rows.extend(self.conn.execute(f'{query} WHERE path IN ({",".join("?" * len(chunk))})', chunk).fetchall())
+        return({row[0]: row[1:9] + (bool(row[9]),) for row in rows})
+
+    def Paths(self):
+        """Returns the paths of every cataloged file."""
+        with self.lock:
+            return([row[0] for row in self.conn.execute('SELECT path FROM files')])
+
+    def Update(self, changed, removed = (), dirs = None, removed_dirs = ()):
+        """Upserts `changed` rows, (path, mtime, size, var, tile, quantity, date, res, proj, native), and drops `removed` paths in one transaction.
+
+        `dirs` {directory: (mtime, [(name, is_dir)])} and `removed_dirs`
+        likewise update the directory listings.
+        """
+        if not changed and not removed and not dirs and not removed_dirs:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', changed)
+            self.conn.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+            self.conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                                  [(path, mtime, json.dumps(entries)) for path, (mtime, entries) in (dirs or {}).items()])
+            self.conn.executemany('DELETE FROM dirs WHERE path = ?', [(path,) for path in removed_dirs])
+
+    def Close(self):
+        with self.lock:
+            self.conn.close()
+
+class OSFFile:
+    """The attributes of an osfclient File that queries and downloads use, so listings can be cached offline."""
+    def __init__(self, path, size, hashes, download_url, date_modified):
+        self.path = path
+        self.size = size
+        self.hashes = hashes
+        self.download_url = download_url
+        self.date_modified = date_modified
+
+    def __eq__(self, other):
+        return(isinstance(other, OSFFile) and (self.path, self.size, self.hashes, self.download_url, self.date_modified) ==
+               (other.path, other.size, other.hashes, other.download_url, other.date_modified))
+
+    def __hash__(self):
+        return(hash(self.path))
+
+class OSFListing:
+    """Local copy of an OSF project's file listing and the time it was taken."""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path, self.conn = OpenDatabase(path, self.Setup)
+
+    def Setup(self, conn):
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS osf_files (
+                                path TEXT PRIMARY KEY,
+                                size INTEGER,
+                                md5 TEXT,
+                                sha256 TEXT,
+                                download_url TEXT NOT NULL,
+                                modified TEXT)''')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+
+    def Load(self):
+        """Returns (listed_at, {path: OSFFile}); listed_at is None if no listing was ever stored."""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'listed_at'").fetchone()
+            rows = self.conn.execute('SELECT path, size, md5, sha256, download_url, modified FROM osf_files').fetchall()
+        files = {}
+        for path, size, md5, sha256, download_url, modified in rows:
+            hashes = {name: value for name, value in (('md5', md5), ('sha256', sha256)) if value}
+            files[path] = OSFFile(path, size, hashes, download_url, modified)
+        return(None if row is None else row[0], files)
+
+    def Store(self, files, listed_at):
+        """Replaces the stored listing with `files`, a {path: OSFFile} dict."""
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM osf_files')
+            self.conn.executemany('INSERT INTO osf_files VALUES (?, ?, ?, ?, ?, ?)',
+                                  [(f.path, f.size, (f.hashes or {}).get('md5'), (f.hashes or {}).get('sha256'), f.download_url, f.date_modified)
+                                   for f in files.values()])
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('listed_at', ?)", (listed_at,))
+
+class SentinelCatalog:
+    """Record of downloaded Sentinel products and their projections, shared by every process using `path`.
+
+    Each AddProduct() and AddProjection() is committed at once. Products are
+    read from the database the first time they are asked for and kept in
+    memory after that.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.products = {}
+        self.path, self.conn = OpenDatabase(path, self.Setup)
+
+    def Setup(self, conn):
+        with conn:
+            # `metadata` is the pickled sentinelsat product dictionary.
+            conn.execute('''CREATE TABLE IF NOT EXISTS products (
+                                id TEXT PRIMARY KEY,
+                                metadata BLOB NOT NULL,
+                                measurements TEXT NOT NULL)''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS projections (
+                                product TEXT NOT NULL,
+                                band TEXT NOT NULL,
+                                polarity TEXT NOT NULL,
+                                projection TEXT NOT NULL,
+                                resolution REAL NOT NULL,
+                                path TEXT NOT NULL,
+                                PRIMARY KEY (product, band, polarity, projection, resolution))''')
+            conn.execute('CREATE INDEX IF NOT EXISTS projections_path ON projections (path)')
+
+    def Product(self, product):
+        """Returns {'product': metadata, 'measurements': [path, ...]} for a downloaded product, or None."""
+        with self.lock:
+            if product not in self.products:
+                row = self.conn.execute('SELECT metadata, measurements FROM products WHERE id = ?', (product,)).fetchone()
+                if row is None:
+                    return(None)
+                self.products[product] = {'product': pickle.loads(row[0]), 'measurements': json.loads(row[1])}
+            return(self.products[product])
+
+    def __contains__(self, product):
+        return(self.Product(product) is not None)
+
+    def AddProduct(self, product, metadata, measurements):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO products VALUES (?, ?, ?)', (product, pickle.dumps(metadata), json.dumps(measurements)))
+            self.products[product] = {'product': metadata, 'measurements': list(measurements)}
+
+    def Projection(self, product, band, polarity, projection, resolution):
+        """Returns the path of a recorded projection, or None."""
+        with self.lock:
+            row = self.conn.execute('SELECT path FROM projections WHERE product = ? AND band = ? AND polarity = ? AND projection = ? AND resolution = ?',
+                                    (product, band, polarity, projection, resolution)).fetchone()
+        return(None if row is None else row[0])
+
+    def AddProjection(self, product, band, polarity, projection, resolution, path):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO projections VALUES (?, ?, ?, ?, ?, ?)', (product, band, polarity, projection, resolution, path))
+
+    def RemoveProjection(self, path):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM projections WHERE path = ?', (path,))
+
+    def Import(self, db):
+        """Adds the products and projections of a {product: {'product', 'measurements', 'projections'}} dict, keeping existing rows."""
+        with self.lock, self.conn:
+            for product, entry in db.items():
+                if 'measurements' not in entry:
+                    continue
+                self.conn.execute('INSERT OR IGNORE INTO products VALUES (?, ?, ?)', (product, pickle.dumps(entry['product']), json.dumps(entry['measurements'])))
+                self.conn.executemany('INSERT OR IGNORE INTO projections VALUES (?, ?, ?, ?, ?, ?)',
+                                      [(product, band, polarity, projection, resolution, path)
+                                       for (band, polarity, projection, resolution), path in entry.get('projections', {}).items()])
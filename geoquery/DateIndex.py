@@ -0,0 +1,79 @@
+import numpy as np
+
+DATE_POLICIES = ('all', 'earliest', 'latest')
+
+class DateIndex:
+    """Measurements of one tile and quantity, ordered by acquisition date.
+
+    Dates are held in a sorted datetime64 array, so range lookups are a binary
+    search. Otherwise behaves like a {date: [measurement, ...]} dict whose
+    iteration order is date order.
+    """
+    def __init__(self):
+        self.dates = np.array([], dtype='datetime64[us]')
+        self.measurements = []
+
+    def Find(self, date):
+        key = np.datetime64(date, 'us')
+        i = int(np.searchsorted(self.dates, key))
+        return(i, key, i < len(self.dates) and self.dates[i] == key)
+
+    def __len__(self):
+        return(len(self.measurements))
+
+    def __iter__(self):
+        return(iter(self.dates.tolist()))
+
+    def __contains__(self, date):
+        return(self.Find(date)[2])
+
+    def __getitem__(self, date):
+        i, ignored, found = self.Find(date)
+        if not found:
+            raise KeyError(date)
+        return(self.measurements[i])
+
+    def __setitem__(self, date, measurements):
+        i, key, found = self.Find(date)
+        if found:
+            self.measurements[i] = measurements
+        else:
+            self.dates = np.insert(self.dates, i, key)
+            self.measurements.insert(i, measurements)
+
+    def __delitem__(self, date):
+        i, ignored, found = self.Find(date)
+        if not found:
+            raise KeyError(date)
+        self.dates = np.delete(self.dates, i)
+        del self.measurements[i]
+
+    def get(self, date, default = None):
+        i, ignored, found = self.Find(date)
+        return(self.measurements[i] if found else default)
+
+    def items(self):
+        return(zip(self.dates.tolist(), self.measurements))
+
+    def Range(self, sdate, edate):
+        """Returns the [lo, hi) positions of the dates in [sdate, edate]."""
+        lo = int(np.searchsorted(self.dates, np.datetime64(sdate, 'us'), side='left'))
+        hi = int(np.searchsorted(self.dates, np.datetime64(edate, 'us'), side='right'))
+        return(lo, max(lo, hi))
+
+    def Select(self, sdate, edate, policy = 'earliest'):
+        """Returns [(date, measurements)] for the dates in [sdate, edate].
+
+        `policy` is 'all' for every match in date order, or 'earliest' or
+        'latest' for at most the single first or last match.
+        """
+        lo, hi = self.Range(sdate, edate)
+        if lo == hi:
+            return([])
+        if policy == 'earliest':
+            hi = lo + 1
+        elif policy == 'latest':
+            lo = hi - 1
+        elif policy != 'all':
+            raise ValueError(f'unknown date policy: {policy}')
+        return(list(zip(self.dates[lo:hi].tolist(), self.measurements[lo:hi])))
@@ -0,0 +1,124 @@
+import hashlib
+import shutil
+import time
+import sys
+import os
+
+from .Storage import AtomicWrite
+
+class DownloadError(Exception):
+    pass
+
+def VerifyFile(path, size = None, md5 = None, sha256 = None):
+    """Raises DownloadError unless the file at `path` has the expected size and checksums."""
+    if size is not None and os.path.getsize(path) != size:
+        raise DownloadError(f'{path}: expected {size} bytes, found {os.path.getsize(path)}')
+    digests = {}
+    if md5:
+        digests['md5'] = (hashlib.md5(), md5)
+    if sha256:
+        digests['sha256'] = (hashlib.sha256(), sha256)
+    if digests:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                for digest, ignored in digests.values():
+                    digest.update(chunk)
+        for name, (digest, expected) in digests.items():
+            if digest.hexdigest() != expected.lower():
+                raise DownloadError(f'{path}: {name} mismatch')
+
+def FetchURL(url, tgtfile, size = None, md5 = None, sha256 = None, headers = None, auth = None, retries = 4, backoff = 1.0, timeout = 60):
+    """Downloads `url` to `tgtfile`, verifying it before it appears under its final name.
+
+    Data is written to `<tgtfile>.part`. An interrupted transfer is resumed
+    from there with a Range request on the next attempt or call. Failed
+    attempts are retried `retries` times, waiting `backoff` seconds and
+    doubling the wait after each failure. A file that fails verification is
+    discarded and downloaded again from the start, except after the last
+    attempt, when `<tgtfile>.part` is kept for inspection and DownloadError
+    raised. The next call verifies it again before downloading anything.
+    """
+    # Imported here so that adapters which never download do not load requests.
+    import requests
+    part = f'{tgtfile}.part'
+    for attempt in range(retries + 1):
+        try:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if size is not None and offset >= size:
+                # Nothing left to request; verify what we have below.
+                request_headers = None
+            else:
+                request_headers = dict(headers or {})
+                if offset:
+                    request_headers['Range'] = f'bytes={offset}-'
+            if request_headers is not None:
+                with requests.get(url, headers = request_headers, auth = auth, stream = True, timeout = timeout) as response:
+                    if response.status_code == 206:
+                        mode = 'ab'
+                    elif response.status_code == 200:
+                        mode = 'wb'
+                    elif response.status_code == 416 and offset:
+                        # Nothing after `offset`: the part file is complete, or wrong and discarded below.
+                        mode = None
+                    else:
+                        raise DownloadError(f'{url}: response has status code {response.status_code}')
+                    if mode is not None:
+                        with open(part, mode) as fp:
+                            for chunk in response.iter_content(1 << 16):
+                                fp.write(chunk)
+            try:
+                VerifyFile(part, size, md5, sha256)
+            except DownloadError:
+                if attempt < retries:
+                    os.remove(part)
+                raise
+            os.replace(part, tgtfile)
+            return(tgtfile)
+        except (requests.RequestException, OSError, DownloadError):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+class SentinelHubBackend:
+    """Downloads Sentinel products from the Copernicus hub through a sentinelsat API object."""
+    def __init__(self, api):
+        self.api = api
+
+    def Fetch(self, product, metadata, path):
+        """Downloads `product` to `path`, which sentinelsat names `<title>.zip`."""
+        self.api.download(product, directory_path = os.path.dirname(path) or '.')
+
+class SentinelMirrorBackend:
+    """Fetches Sentinel products from a mirror of `<title>.zip` archives, such as a local mirror of the hub.
+
+    `directory` is a directory of archives, which are copied, or the
+    http(s) URL of one, from which they are downloaded with FetchURL() and
+    its `retries` and `backoff`. If `fallback`, another backend such as
+    SentinelHubBackend, is given, products the mirror fails to provide are
+    fetched with it instead.
+    """
+    def __init__(self, directory, fallback = None, retries = 4, backoff = 1.0):
+        self.directory = directory
+        self.fallback = fallback
+        self.retries = retries
+        self.backoff = backoff
+
+    def Fetch(self, product, metadata, path):
+        try:
+            if self.directory.startswith(('http://', 'https://')):
+                FetchURL(f"{self.directory.rstrip('/')}/{metadata['title']}.zip", path, retries = self.retries, backoff = self.backoff)
+            else:
+                self.Copy(product, metadata, path)
+        except (DownloadError, OSError) as e:
+            # requests' exceptions are OSErrors too.
+            if self.fallback is None:
+                raise
+            print(f'{product}: mirror {self.directory} failed ({e}), fetching it from the fallback backend', file=sys.stderr)
+            self.fallback.Fetch(product, metadata, path)
+
+    def Copy(self, product, metadata, path):
+        source = os.path.join(self.directory, f"{metadata['title']}.zip")
+        if not os.path.exists(source):
+            raise DownloadError(f'{product}: {source} is not in the mirror')
+        with AtomicWrite(path) as tmp_file:
+            shutil.copyfile(source, tmp_file)
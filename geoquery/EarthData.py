@@ -0,0 +1,1021 @@
+import mgrs
+from osgeo import gdal
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dateutil import parser
+import numpy as np
+import threading
+import glob
+import time
+import sys
+import os
+
+from .MGRSIndex import GetMGRSIdx, GetMGRSGrid
+from .Catalog import LocalCatalog, OSFListing, OSFFile
+from .DateIndex import DateIndex, DATE_POLICIES
+from .ProjectionCache import ProjectionCache
+from .Download import FetchURL, VerifyFile, DownloadError
+from .TimeSeries import TimeSeriesCube, REDUCTIONS
+from .Instrumentation import Measure, Bind
+from .Raster import (GetSRCoord, TransformCoords, WarpToFile, BuildOverviews, RESULT_GTIFF_OPTIONS, WarpWindow, WarpGrid, RasterType,
+                     ReadWindowRows, WarpRows, ReadPoints, PolygonMask, MosaicWriter)
+
+def GetTile(name):
+    """Returns the (<zone><band>, <column><row>) directories an HLS file belongs in, or (None, None) if `name` is not a GeoTIFF."""
+    metadata = name.split('.')
+    if metadata[-1] == 'tif' or metadata[-1] == 'tiff':
+        tile = metadata[2][1:]
+        return(tile[0:-2], tile[-2:])
+    else:
+        return(None, None)
+
+def MeasurementKey(metadata):
+    """Returns (var, tile, quantity, date) from the dot-separated parts of an HLS file name."""
+    return(metadata[0].upper(), metadata[2][1:], metadata[6], parser.isoparse(metadata[3]))
+
+# BuildMany() reads the windows of several queries in one product together
+# unless their bounding box is more than this many times their total area.
+UNION_READ_RATIO = 2
+
+def MGRStoTuple(m):
+    return(int(m[0:2]), m[2], m[3], m[4], m[5:])
+
+class EarthDataBoxQuery:
+    def __init__(self, api, target, lon1, lat1, lon2, lat2, sdate, edate):
+        self.api = api
+        m = mgrs.MGRS()
+        bl = m.toMGRS(min(lat1, lat2), min(lon1, lon2), MGRSPrecision = 0)
+        tr = m.toMGRS(max(lat1, lat2), max(lon1, lon2), MGRSPrecision = 0)
+        self.bl = MGRStoTuple(bl)
+        self.tr = MGRStoTuple(tr)
+        self.sdate = parser.isoparse(sdate)
+        self.edate = parser.isoparse(edate)
+        try:
+            self.var, argpart = target.split('^')
+        except ValueError:
+            self.var, argpart = target, ''
+        self.var = self.var.upper()
+        self.args = {}
+        for arg in argpart.split(','):
+            if arg:
+                key, value = arg.split('=')
+                self.args[key] = value
+        self.policy = self.args.get('dates', 'earliest')
+        if self.policy not in DATE_POLICIES:
+            raise ValueError(f"unknown dates modifier: {self.policy}")
+    def GetProductList(self):
+        self.products = self.api.Query(self.bl, self.tr, self.sdate, self.edate, self.var, self.policy)
+        return(self.products)
+
+class EarthDataOSFAccess:
+    def __init__(self, directory, osf_url = None, listing_ttl = 3600):
+        # Only the OSF provider needs osfclient, so it is imported on first use.
+        import osfclient
+        from osfclient.exceptions import OSFException
+        import requests
+        self.project = directory
+        self.osf = osfclient.OSF()
+        if osf_url is not None:
+            self.osf.session.base_url = osf_url
+        self.db = {}
+        # path -> (var, tile, quantity, date) of the products added by AddMeasurement()
+        self.products = {}
+        # OSF path -> (OSFFile, measurement or None) for every file in the listing
+        self.remote = {}
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+        os.makedirs(self.project, exist_ok = True)
+        self.listing = OSFListing(f'{self.project}/.geoquery_listing.sqlite')
+        listed_at, files = self.listing.Load()
+        # Applied first, so that a refresh diffs against it and removes the
+        # downloads and products of files that changed since it was taken.
+        self.Apply(files)
+        if listed_at is None or time.time() - listed_at > listing_ttl:
+            try:
+                self.Refresh()
+            except (requests.RequestException, RuntimeError, OSFException) as e:
+                if listed_at is None:
+                    raise
+                print(f'could not list OSF project {self.project}, using the listing from {time.ctime(listed_at)}: {e}', file=sys.stderr)
+
+    def ListProject(self):
+        files = {}
+        p = self.osf.project(self.project)
+        for s in p.storages:
+            for f in s.files:
+                files[f.path] = OSFFile(f.path, f.size, f.hashes or {}, f._download_url, f.date_modified)
+        return(files)
+
+    def Refresh(self, full = False):
+        """Lists the OSF project again and applies the differences to `db` and the cached listing.
+
+        Returns the OSF paths that were added or changed, and those that were removed.
+        """
+        with self.refresh_lock:
+            listed_at = time.time()
+            files = self.ListProject()
+            added, removed = self.Apply(files)
+            self.listing.Store(files, listed_at)
+            return(added, removed)
+
+    def Apply(self, files):
+        added = []
+        removed = []
+        with self.lock:
+            for fname in [fname for fname in self.remote if fname not in files]:
+                self.RemoveRemote(fname)
+                removed.append(fname)
+            for fname, f in files.items():
+                if fname in self.remote:
+                    if self.remote[fname][0] == f:
+                        continue
+                    self.RemoveRemote(fname)
+                self.AddRemote(f)
+                added.append(fname)
+        return(added, removed)
+
+    def AddRemote(self, f):
+        fname = f.path
+        measurement = None
+        fparts = fname.split('/')
+        if len(fparts) == 4:
+            first = fparts[1]
+            second = fparts[2]
+            metadata = fparts[3].split('.')
+            if metadata[-1] == 'tif' or metadata[-1] == 'tiff':
+                var = metadata[0].upper()
+                tile = metadata[2][1:]
+                quant = metadata[6]
+                if var not in self.db:
+                    self.db[var] = {}
+                date = parser.isoparse(metadata[3])
+                if tile not in self.db[var]:
+                    self.db[var][tile] = {}
+                if quant not in self.db[var][tile]:
+                    self.db[var][tile][quant] = DateIndex()
+                if date not in self.db[var][tile][quant]:
+                    self.db[var][tile][quant][date] = []
+                measurement = (-1, '', True, f)
+                self.db[var][tile][quant][date].append(measurement)
+                measurement = (var, tile, quant, date)
+        self.remote[fname] = (f, measurement)
+
+    def RemoveRemote(self, fname):
+        """Forgets the OSF file `fname`, and deletes its download and the products reprojected from it."""
+        f, measurement = self.remote.pop(fname)
+        if measurement is None:
+            return
+        var, tile, quant, date = measurement
+        target = self.LocalPath(f)
+        stale = {target} | {path for path, product in self.products.items() if product == measurement}
+        for path in stale:
+            self.products.pop(path, None)
+        measurements = self.db[var][tile][quant].get(date, [])
+        measurements[:] = [m for m in measurements if m[3] is not f and m[3] not in stale]
+        if not measurements:
+            if date in self.db[var][tile][quant]:
+                del self.db[var][tile][quant][date]
+            if not self.db[var][tile][quant]:
+                del self.db[var][tile][quant]
+                if not self.db[var][tile]:
+                    del self.db[var][tile]
+        # Also covers files left by an earlier process, which were never added to `products`.
+        root, ext = os.path.splitext(target)
+        for path in [target, f'{target}.ovr'] + glob.glob(f'{glob.escape(root)}.*{ext}'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def LocalPath(self, f):
+        """Returns the path GetProducts() downloads the OSF file `f` to."""
+        name = f.path.split('/')[-1]
+        tile = name.split('.')[2][1:]
+        return(f'{self.project}/{int(tile[0:-3])}{tile[-3]}/{tile[-2:]}/{name}')
+
+    def AddMeasurement(self, var, tile, quant, date, measurement):
+        with self.lock:
+            measurements = self.db.get(var, {}).get(tile, {}).get(quant, {}).get(date)
+            if measurements is None:
+                # The OSF file was removed while the product was being made.
+                return
+            measurements.append(measurement)
+            self.products[measurement[3]] = (var, tile, quant, date)
+
+    def RemoveMeasurement(self, path):
+        with self.lock:
+            if path in self.products:
+                var, tile, quant, date = self.products.pop(path)
+                measurements = self.db[var][tile][quant][date]
+                measurements[:] = [m for m in measurements if m[3] != path]
+
+    def Download(self, file, tgtfile):
+        """Downloads the OSF `file` to `tgtfile` unless an up-to-date copy is already there."""
+        if os.path.exists(tgtfile) and self.IsCurrent(file, tgtfile):
+            return(tgtfile)
+        hashes = file.hashes or {}
+        with Measure('download', tiles = 1) as stage:
+            FetchURL(file.download_url, tgtfile, file.size, hashes.get('md5'), hashes.get('sha256'),
+                     headers = dict(self.osf.session.headers), auth = self.osf.session.auth)
+            stage.Add(bytes_written = os.path.getsize(tgtfile))
+        return(tgtfile)
+
+    def IsCurrent(self, file, path):
+        """Returns whether `path` is a download of the current version of the OSF `file`.
+
+        It must match the file's checksums, or, if OSF lists none, its size,
+        and be no older than the file's date_modified.
+        """
+        hashes = file.hashes or {}
+        try:
+            VerifyFile(path, file.size, hashes.get('md5'), hashes.get('sha256'))
+        except DownloadError:
+            return(False)
+        if hashes or not file.date_modified:
+            return(True)
+        return(os.path.getmtime(path) >= parser.isoparse(file.date_modified).timestamp())
+
+    @property
+    def mdb(self):
+        return(GetMGRSIdx())
+
+    def FindIntermediateTiles(self, bl, tr):
+        grid = GetMGRSGrid()
+        return(grid.Tuples(grid.FindTiles(bl, tr)))
+
+    def Query(self, bl, tr, sdate, edate, var, policy = 'earliest'):
+        """Returns the measurements of `var` between `bl` and `tr` dated within [sdate, edate].
+
+        `policy` picks which dates are returned per tile and quantity: 'all'
+        (in date order), or only the 'earliest' or 'latest' one. `dates`
+        holds the date of each result.
+        """
+        results = []
+        dates = []
+        grid = GetMGRSGrid()
+        tiles_between = grid.FindTiles(bl, tr)
+        with self.lock:
+            for tile_id, tile_str in zip(tiles_between.tolist(), grid.names[tiles_between].tolist()):
+                if tile_str in self.db[var]:
+                    tile = grid.Tuples([tile_id])[0]
+                    for quantity in self.db[var][tile_str]:
+                        for date, measurements in self.db[var][tile_str][quantity].Select(sdate, edate, policy):
+                            results.append((tile, quantity, measurements))
+                            dates.append(date)
+        return({'var': var, 'project': self.project, 'results': results, 'dates': dates})
+
+def ScanLocalMeasurement(path, metadata):
+    dat = gdal.Open(path)
+    if(len(metadata) < 9):
+        geo = dat.GetGeoTransform()
+        res = geo[1]
+        native = True
+    else:
+        res = metadata[7]
+        native = False
+    ref = dat.GetSpatialRef()
+    proj = ref.GetAuthorityCode('PROJCS')
+    return(res, proj, native)
+
+class EarthDataLocalAccess:
+    def __init__(self, directory, catalog = None):
+        # Normalized so that tile directories sit exactly two levels below it, and
+        # catalog paths match however the directory is spelled, e.g. with a trailing slash.
+        self.dir = os.path.normpath(directory)
+        if not os.path.isdir(self.dir):
+            raise FileNotFoundError(f'{directory} is not a directory')
+        if catalog is None:
+            catalog = f'{self.dir}/.geoquery_catalog.sqlite'
+        self.catalog = LocalCatalog(catalog)
+        self.db = {}
+        # path -> (mtime, size, var, tile, quantity, date, measurement) for every file in `db`
+        self.files = {}
+        # directory -> (mtime, [(name, is_dir)]) as of the last refresh
+        self.dirs = {}
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+        self.Load()
+        self.Refresh()
+
+    def Load(self):
+        """Fills `dirs`, `files` and `db` from the catalog, as the last refresh of any process left them.
+
+        The first Refresh() then only relists the directories that changed
+        since, so a warm start costs in proportion to what changed. A tile
+        directory with a file the catalog has no row for is left out, so it
+        is relisted and the file scanned.
+        """
+        dirs, records = self.catalog.LoadTree()
+        for path, (mtime, entries) in dirs.items():
+            if os.path.dirname(os.path.dirname(path)) != self.dir:
+                self.dirs[path] = (mtime, entries)
+                continue
+            files = [f'{path}/{name}' for name, isdir in entries if name.split('.')[-1] in ('tif', 'tiff')]
+            if any(file not in records for file in files):
+                continue
+            self.dirs[path] = (mtime, entries)
+            for file in files:
+                file_mtime, size, var, tile, quant, date, res, proj, native = records[file]
+                self.AddMeasurement(var, tile, quant, datetime.fromisoformat(date), (res, proj, native, file), (file_mtime, size))
+
+    def ListDir(self, path, full):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            # A tile directory removed since its parent was listed is empty, but a missing tree is an error.
+            if path == self.dir:
+                raise
+            return([], True)
+        cached = self.dirs.get(path)
+        if not full and cached is not None and cached[0] == mtime:
+            return(cached[1], False)
+        entries = [(entry.name, entry.is_dir()) for entry in os.scandir(path)]
+        self.dirs[path] = (mtime, entries)
+        return(entries, True)
+
+    def Refresh(self, full = False):
+        """Brings `db` and the catalog up to date with the directory tree.
+
+        Only directories whose mtime changed since the last refresh are
+        relisted, and only new or modified GeoTIFFs are opened with GDAL.
+        `full` relists every directory, which also catches files rewritten in
+        place, and drops the catalog rows of files that are gone. Queries may
+        run concurrently. Returns the added and removed paths. Raises
+        FileNotFoundError if the directory itself is missing.
+        """
+        with self.refresh_lock:
+            listed = dict(self.dirs)
+            visited = {self.dir}
+            relisted = set()
+            candidates = {}
+            root, ignored = self.ListDir(self.dir, full)
+            for first, isdir in root:
+                firstf = f'{self.dir}/{first}'
+                if isdir:
+                    visited.add(firstf)
+                    zone, ignored = self.ListDir(firstf, full)
+                    for second, isdir in zone:
+                        secondf = f'{firstf}/{second}'
+                        if isdir:
+                            visited.add(secondf)
+                            files, changed = self.ListDir(secondf, full)
+                            if changed:
+                                relisted.add(secondf)
+                                for file, isdir in files:
+                                    metadata = file.split('.')
+                                    if metadata[-1] == 'tif' or metadata[-1] == 'tiff':
+                                        candidates[f'{secondf}/{file}'] = metadata
+            for path in list(self.dirs):
+                if path not in visited:
+                    del self.dirs[path]
+
+            removed = []
+            for path in list(self.files):
+                parent = os.path.dirname(path)
+                if parent not in visited or (parent in relisted and path not in candidates):
+                    removed.append(path)
+            known = self.catalog.Load([path for path in candidates if path not in self.files])
+            added = []
+            changed = []
+            for path, metadata in candidates.items():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    if path in self.files:
+                        removed.append(path)
+                    continue
+                current = self.files.get(path)
+                if current is not None and current[0] == stat.st_mtime_ns and current[1] == stat.st_size:
+                    continue
+                record = known.get(path)
+                if record is not None and record[0] == stat.st_mtime_ns and record[1] == stat.st_size:
+                    ignored, ignored, var, tile, quant, date, res, proj, native = record
+                    date = datetime.fromisoformat(date)
+                else:
+                    var, tile, quant, date = MeasurementKey(metadata)
+                    res, proj, native = ScanLocalMeasurement(path, metadata)
+                    changed.append((path, stat.st_mtime_ns, stat.st_size, var, tile, quant, date.isoformat(), res, proj, native))
+                added.append((var, tile, quant, date, (res, proj, native, path), (stat.st_mtime_ns, stat.st_size)))
+            # A full refresh sees every file, so it also drops the rows of files deleted while no process was watching.
+            stale = [path for path in self.catalog.Paths() if path not in candidates and path not in self.files] if full else []
+
+            with self.lock:
+                for path in removed:
+                    self.RemoveMeasurement(path)
+                for var, tile, quant, date, measurement, stat in added:
+                    self.AddMeasurement(var, tile, quant, date, measurement, stat)
+            # Saved with the files, so the next process to start only relists what changed after this.
+            dirs = {path: listing for path, listing in self.dirs.items() if listed.get(path) != listing}
+            self.catalog.Update(changed, removed + stale, dirs, [path for path in listed if path not in self.dirs])
+            return([measurement[3] for ignored, ignored, ignored, ignored, measurement, ignored in added], removed)
+
+    def AddMeasurement(self, var, tile, quant, date, measurement, stat = None):
+        """Adds `measurement` to `db`; `stat` is the file's (mtime in ns, size), read from disk if None."""
+        path = measurement[3]
+        if stat is None:
+            stat = os.stat(path)
+            stat = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if path in self.files:
+                self.RemoveMeasurement(path)
+            if var not in self.db:
+                self.db[var] = {}
+            if tile not in self.db[var]:
+                self.db[var][tile] = {}
+            if quant not in self.db[var][tile]:
+                self.db[var][tile][quant] = DateIndex()
+            # Measurement lists are replaced rather than mutated, so results
+            # handed out by Query() are unaffected by a concurrent refresh.
+            self.db[var][tile][quant][date] = self.db[var][tile][quant].get(date, []) + [measurement]
+            self.files[path] = (stat[0], stat[1], var, tile, quant, date, measurement)
+
+    def RemoveMeasurement(self, path):
+        with self.lock:
+            if path not in self.files:
+                return
+            ignored, ignored, var, tile, quant, date, measurement = self.files.pop(path)
+            remaining = [m for m in self.db[var][tile][quant][date] if m[3] != path]
+            if remaining:
+                self.db[var][tile][quant][date] = remaining
+            else:
+                del self.db[var][tile][quant][date]
+                if not self.db[var][tile][quant]:
+                    del self.db[var][tile][quant]
+                    if not self.db[var][tile]:
+                        del self.db[var][tile]
+
+    @property
+    def mdb(self):
+        return(GetMGRSIdx())
+
+    def FindIntermediateTiles(self, bl, tr):
+        grid = GetMGRSGrid()
+        return(grid.Tuples(grid.FindTiles(bl, tr)))
+
+    def Query(self, bl, tr, sdate, edate, var, policy = 'earliest'):
+        """Returns the measurements of `var` between `bl` and `tr` dated within [sdate, edate].
+
+        `policy` picks which dates are returned per tile and quantity: 'all'
+        (in date order), or only the 'earliest' or 'latest' one. `dates`
+        holds the date of each result.
+        """
+        results = []
+        dates = []
+        grid = GetMGRSGrid()
+        tiles_between = grid.FindTiles(bl, tr)
+        with self.lock:
+            for tile_id, tile_str in zip(tiles_between.tolist(), grid.names[tiles_between].tolist()):
+                if tile_str in self.db[var]:
+                    tile = grid.Tuples([tile_id])[0]
+                    for quantity in self.db[var][tile_str]:
+                        for date, measurements in self.db[var][tile_str][quantity].Select(sdate, edate, policy):
+                            results.append((tile, quantity, measurements))
+                            dates.append(date)
+        return({'var': var, 'results': results, 'dates': dates})
+
+class EarthDataAdapter:
+
+    def __init__(self, directory, provider = 'local', catalog = None, workers = 1, virtual = False, cache_budget = None, cache_policy = 'lru',
+                 download_workers = 4, osf_url = None, listing_ttl = 3600, overviews = False):
+        self.dir = directory
+        self.provider = provider
+        self.virtual = virtual
+        self.overviews = overviews
+        self.overview_locks = {}
+        self.download_workers = download_workers
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        # Each concurrent warp gets an equal share of the cores.
+        self.warp_threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self.pool = None
+        self.warps = {}
+        self.warp_lock = threading.RLock()
+        self.download_pool = None
+        self.fetches = {}
+        self.fetch_lock = threading.RLock()
+        if provider == 'local':
+            self.api = EarthDataLocalAccess(self.dir, catalog)
+        elif provider == 'osf':
+            self.api = EarthDataOSFAccess(self.dir, osf_url, listing_ttl)
+        else:
+            raise ValueError(f"unknown provider: {provider}")
+        self.cache = ProjectionCache(f'{self.dir}/.geoquery_cache.sqlite', cache_budget, cache_policy, self.api.RemoveMeasurement)
+        self.watcher = None
+
+    def Refresh(self, full = False):
+        return(self.api.Refresh(full))
+
+    def Watch(self, interval):
+        """Calls Refresh() every `interval` seconds on a background thread until StopWatch().
+
+        A refresh that fails is reported on stderr, and polling goes on.
+        """
+        if self.watcher is not None:
+            return
+        stop = threading.Event()
+        def Poll():
+            while not stop.wait(interval):
+                try:
+                    self.Refresh()
+                except Exception as e:
+                    # Any failure, e.g. a locked catalog or an unreachable OSF, is reported and retried at the next poll.
+                    print(f'catalog refresh failed: {e!r}', file=sys.stderr)
+        self.watcher = (threading.Thread(target=Poll, daemon=True), stop)
+        self.watcher[0].start()
+
+    def StopWatch(self):
+        if self.watcher is not None:
+            thread, stop = self.watcher
+            stop.set()
+            thread.join()
+            self.watcher = None
+    
+    def CreateQuery(self, target, lon1, lat1, lon2, lat2, sdate, edate):
+        return(EarthDataBoxQuery(self.api, target, lon1, lat1, lon2, lat2, sdate, edate))
+
+    def GetProducts(self, query_result):
+        if self.provider == 'osf':
+            project = query_result['project']
+            products = query_result['results']
+            os.makedirs(project, exist_ok = True)
+            downloads = {}
+            targets = {}
+            for tile, quantity, measurements in products:
+                for (ignored, ignored, ignored, file) in measurements:
+                    if isinstance(file, str):
+                        # Already downloaded or reprojected by an earlier query.
+                        continue
+                    targets[file] = self.api.LocalPath(file)
+                    # Raises FileExistsError if a path component is not a directory.
+                    os.makedirs(os.path.dirname(targets[file]), exist_ok = True)
+                    downloads[targets[file]] = file
+            self.FetchFiles(downloads)
+            # Another query may be rewriting the same measurement lists.
+            with self.api.lock:
+                self.UpdateDownloaded(products, targets)
+
+    def UpdateDownloaded(self, products, targets):
+        """Replaces the OSF files in `products` by the local measurements they were downloaded to."""
+        for tile, quantity, measurements in products:
+            dl_products = []
+            for measurement in measurements:
+                if isinstance(measurement[3], str) or measurement[3] not in targets:
+                    dl_products.append(measurement)
+                    continue
+                tgtfile = targets[measurement[3]]
+                dat = gdal.Open(tgtfile)
+                geo = dat.GetGeoTransform()
+                res = geo[1]
+                native = True
+                ref = dat.GetSpatialRef()
+                proj = ref.GetAuthorityCode('PROJCS')
+                dl_products.append((res, proj, native, tgtfile))
+            measurements.clear()
+            measurements.extend(dl_products)
+
+    def FetchFiles(self, downloads):
+        """Downloads {tgtfile: OSF file}, up to `download_workers` at once.
+
+        A file that another query on this adapter is already downloading is
+        waited on instead of fetched again.
+        """
+        futures = {}
+        with self.fetch_lock:
+            if self.download_pool is None:
+                self.download_pool = ThreadPoolExecutor(self.download_workers)
+            for tgtfile, file in downloads.items():
+                future = self.fetches.get(tgtfile)
+                if future is None:
+                    future = self.download_pool.submit(Bind(self.api.Download), file, tgtfile)
+                    self.fetches[tgtfile] = future
+                    future.add_done_callback(lambda f, tgtfile = tgtfile: self.ForgetFetch(tgtfile))
+                futures[tgtfile] = future
+        for future in futures.values():
+            future.result()
+
+    def ForgetFetch(self, tgtfile):
+        with self.fetch_lock:
+            self.fetches.pop(tgtfile, None)
+
+    def ProjectMeasurement(self, measurement, projection, resolution):
+        root_ext = os.path.splitext(measurement)
+        proj_file = f'{root_ext[0]}.{resolution}{root_ext[1]}'
+        if not self.cache.Lookup(proj_file):
+            self.EnsureOverviews(measurement, projection, resolution)
+            with Measure('warp', tiles = 1) as stage:
+                WarpToFile(proj_file, measurement, dstSRS = projection, xRes = resolution, yRes = resolution,
+                           multithread = True, warpOptions = [f'NUM_THREADS={self.warp_threads}'], creationOptions = RESULT_GTIFF_OPTIONS)
+                stage.Add(bytes_written = os.path.getsize(proj_file))
+            self.cache.Add(proj_file)
+        return(proj_file)
+
+    def EnsureOverviews(self, measurement, projection, resolution):
+        """Builds the overviews of a native product before a coarse warp reads it, if `overviews` is enabled."""
+        if not self.overviews:
+            return
+        with self.warp_lock:
+            lock = self.overview_locks.setdefault(measurement, threading.Lock())
+        with lock:
+            BuildOverviews(measurement, projection, resolution)
+
+    def ProjectMeasurements(self, measurements, projection, resolution):
+        """Reprojects native `measurements`, returning {measurement: proj_file}.
+
+        Up to `workers` warps run at once, on the adapter's pool even when
+        `workers` is 1. A product that another query on this adapter is
+        already warping is waited on instead of warped again.
+        """
+        futures = {}
+        with self.warp_lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(self.workers)
+            for measurement in measurements:
+                key = (measurement, projection, resolution)
+                future = self.warps.get(key)
+                if future is None:
+                    future = self.pool.submit(Bind(self.ProjectMeasurement), measurement, projection, resolution)
+                    self.warps[key] = future
+                    future.add_done_callback(lambda f, key = key: self.ForgetWarp(key))
+                futures[measurement] = future
+        return({m: future.result() for m, future in futures.items()})
+
+    def ForgetWarp(self, key):
+        with self.warp_lock:
+            self.warps.pop(key, None)
+
+    def GetSubset(self, proj_file, projection, lb, ub, resolution):
+        dat = gdal.Open(proj_file)
+        offset, size, ret_offset = self.SubsetWindow(dat, lb, ub, resolution)
+        if size[0] > 0 and size[1] > 0:
+            with Measure('read', tiles = 1) as stage:
+                arr = dat.ReadAsArray(xoff = offset[0], yoff = offset[1], xsize = size[0], ysize = size[1])
+                stage.Add(bytes_read = arr.nbytes)
+        else:
+            arr = None
+        return arr, ret_offset
+
+    def SubsetWindow(self, dat, lb, ub, resolution):
+        """Returns the offset and size of the window of `dat` inside the query grid, and where it lands in the result."""
+        geo = dat.GetGeoTransform()
+        xres = resolution
+        yres = -resolution
+        tl = (min(lb[0], ub[0]), max(lb[1], ub[1]) + resolution)
+        ret_offset = [0, 0]
+        size = [int(abs(ub[0] - lb[0]) / resolution), int(abs(ub[1] - lb[1]) / resolution)]
+        offset = [int((tl[0] - geo[0]) / xres), int((tl[1] - geo[3]) / yres)]
+        if offset[0] < 0:
+            size[0] = size[0] + offset[0]
+            ret_offset[0] = -offset[0]
+            offset[0] = 0
+        if offset[1] < 0:
+            size[1] = size[1] + offset[1]
+            ret_offset[1] = -offset[1]
+            offset[1] = 0
+        if (offset[0] + size[0]) > dat.RasterXSize:
+            size[0] = dat.RasterXSize - offset[0]
+        if (offset[1] + size[1]) > dat.RasterYSize:
+            size[1] = dat.RasterYSize - offset[1]
+        return(offset, size, ret_offset)
+
+
+    def BuildResult(self, query_results, lon1, lat1, lon2, lat2, projection, resolution, output = None, block_size = 512):
+        """Mosaics the query's products into one array per quantity on the query grid.
+
+        With `output`, each quantity is written to `<output>/<quantity>.tif`
+        instead, `block_size` rows at a time, and the paths are returned.
+        """
+        lb = GetSRCoord(lon1, lat1, projection)
+        ub = GetSRCoord(lon2, lat2, projection)
+        width = int(abs(lb[0] - ub[0]) / resolution)
+        height = int(abs(lb[1] - ub[1]) / resolution)
+        results = {}
+        products = query_results['results']
+        if self.virtual:
+            return(self.BuildVirtualResult(products, lb, ub, projection, resolution, output))
+        writer = None if output is None else MosaicWriter(output, projection, lb, ub, resolution, 0, block_size)
+        for tile, quantity, proj_file in self.ProjectProducts(query_results, projection, resolution):
+            if writer is not None:
+                dat = gdal.Open(proj_file)
+                writer.Copy(quantity, dat, *self.SubsetWindow(dat, lb, ub, resolution))
+                continue
+            subset, offset = self.GetSubset(proj_file, projection, lb, ub, resolution)
+            if not subset is None:
+                with Measure('mosaic', bytes_written = subset.nbytes):
+                    if quantity not in results:
+                        results[quantity] = np.ndarray((height, width), dtype=subset.dtype)
+                        results[quantity].fill(0)
+                    results[quantity][offset[1]:offset[1]+subset.shape[0], offset[0]:offset[0]+subset.shape[1]] = subset
+        self.cache.Evict()
+        if writer is not None:
+            return(writer.Close())
+        return(results)
+
+    def ProjectProducts(self, query_results, projection, resolution):
+        """Returns [(tile, quantity, proj_file)] for the query's products, reprojecting those without a usable copy."""
+        var = query_results['var']
+        products = query_results['results']
+        planned = []
+        results = []
+        for tile, quantity, measurements in products:
+            proj_file = None
+            proj_native = False
+            to_reproj = None
+            for (res, proj, native, path) in measurements:
+                # Scanned products record the EPSG code, products reprojected in this session the projection string.
+                if res == resolution and (proj == projection or f'EPSG:{proj}' == projection):
+                    proj_file = path
+                    proj_native = native
+                elif native:
+                    to_reproj = path
+            # Native products already on the query grid are source data, which the cache must never track or evict.
+            if proj_file is not None and not proj_native and not self.cache.Lookup(proj_file):
+                # Evicted or deleted: drop the stale entry and regenerate the product.
+                self.api.RemoveMeasurement(proj_file)
+                proj_file = None
+            if proj_file is None and to_reproj is None:
+                raise FileNotFoundError(f'{tile} {quantity}: no native product to reproject')
+            planned.append((tile, quantity, proj_file, to_reproj if proj_file is None else None))
+        projected = self.ProjectMeasurements([to_reproj for ignored, ignored, ignored, to_reproj in planned if to_reproj is not None], projection, resolution)
+        for tile, quantity, proj_file, to_reproj in planned:
+            if proj_file == None:
+                proj_file = projected[to_reproj]
+                path, file = os.path.split(proj_file)
+                metadata = file.split('.')
+                date = parser.isoparse(metadata[3])
+                tile_str = f'{tile[0]:02d}{tile[1]}{tile[2]}{tile[3]}'
+                self.api.AddMeasurement(var, tile_str, quantity, date, (resolution, projection, False, proj_file))
+            results.append((tile, quantity, proj_file))
+        return(results)
+
+    def BuildVirtualResult(self, products, lb, ub, projection, resolution, output = None):
+        """Mosaics the native measurements of each quantity without writing reprojected files.
+
+        Tiles sharing a projection are combined with BuildVRT and warped onto
+        the query grid in one pass. Later tiles overwrite earlier ones where
+        they have data. With `output`, GDAL warps each quantity straight into
+        `<output>/<quantity>.tif` and the paths are returned.
+        """
+        sources = self.NativeSources(products)
+        for groups in sources.values():
+            for paths in groups.values():
+                for path in paths:
+                    self.EnsureOverviews(path, projection, resolution)
+        if output is not None:
+            return(self.WriteVirtualResult(sources, lb, ub, projection, resolution, output))
+        results = {}
+        for quantity, groups in sources.items():
+            for proj, paths in groups.items():
+                subset, nodata = WarpWindow(paths, projection, resolution, lb, ub)
+                if quantity not in results:
+                    results[quantity] = np.zeros(subset.shape, dtype=subset.dtype)
+                valid = subset != nodata
+                results[quantity][valid] = subset[valid]
+        return(results)
+
+    def NativeSources(self, products):
+        """Groups the native measurement paths of `products` as {quantity: {projection: [path, ...]}}."""
+        sources = {}
+        for tile, quantity, measurements in products:
+            for (res, proj, native, path) in measurements:
+                if native:
+                    sources.setdefault(quantity, {}).setdefault(proj, []).append(path)
+        return(sources)
+
+    def WriteVirtualResult(self, sources, lb, ub, projection, resolution, output):
+        os.makedirs(output, exist_ok = True)
+        results = {}
+        for quantity, groups in sources.items():
+            dat = f'{output}/{quantity}.tif'
+            for proj, paths in groups.items():
+                dat, nodata = WarpWindow(paths, projection, resolution, lb, ub, dat)
+            dat.FlushCache()
+            results[quantity] = f'{output}/{quantity}.tif'
+        return(results)
+
+    def BuildSeries(self, query_results, lon1, lat1, lon2, lat2, projection, resolution, reduce = None, block_size = 512):
+        """Stacks the query's products by date into a (time, y, x) cube per quantity on the query grid.
+
+        Returns {quantity: TimeSeriesCube}. Products of the same date are
+        mosaicked into one layer, and only their windows inside the grid are
+        read, when the layer is used. With `reduce`, one of REDUCTIONS, each
+        cube is reduced over time instead and {quantity: array} is returned.
+        """
+        if reduce is not None and reduce not in REDUCTIONS:
+            raise ValueError(f'unknown reduction: {reduce}')
+        lb = GetSRCoord(lon1, lat1, projection)
+        ub = GetSRCoord(lon2, lat2, projection)
+        width = int(abs(lb[0] - ub[0]) / resolution)
+        height = int(abs(lb[1] - ub[1]) / resolution)
+        left = min(lb[0], ub[0])
+        top = max(lb[1], ub[1]) + resolution
+        layers = {}
+        if self.virtual:
+            # quantity -> {date: {projection: [native path, ...]}}
+            for (tile, quantity, measurements), date in zip(query_results['results'], query_results['dates']):
+                for (res, proj, native, path) in measurements:
+                    if native:
+                        self.EnsureOverviews(path, projection, resolution)
+                        layers.setdefault(quantity, {}).setdefault(date, {}).setdefault(proj, []).append(path)
+        else:
+            # quantity -> {date: [(proj_file, offset, size, ret_offset), ...]}
+            projected = self.ProjectProducts(query_results, projection, resolution)
+            for (tile, quantity, proj_file), date in zip(projected, query_results['dates']):
+                dat = gdal.Open(proj_file)
+                layers.setdefault(quantity, {}).setdefault(date, []).append((proj_file, *self.SubsetWindow(dat, lb, ub, resolution)))
+        results = {}
+        for quantity, by_date in layers.items():
+            dates = sorted(by_date)
+            sources = [by_date[date] for date in dates]
+            if self.virtual:
+                dtype, nodata = RasterType(next(iter(sources[0].values()))[0])
+                read = lambda t, y0, y1, sources = sources, dtype = dtype, nodata = nodata: WarpRows(
+                    sources[t], projection, resolution, left, top, width, y0, y1, dtype, nodata)
+            else:
+                dtype, nodata = RasterType(sources[0][0][0])
+                read = lambda t, y0, y1, sources = sources, dtype = dtype, nodata = nodata: ReadWindowRows(
+                    sources[t], width, y0, y1, dtype, nodata)
+            results[quantity] = TimeSeriesCube(dates, (len(dates), height, width), dtype, nodata, read)
+        if reduce is not None:
+            results = {quantity: cube.Reduce(reduce, block_size) for quantity, cube in results.items()}
+            self.cache.Evict()
+        return(results)
+
+    def SamplePoints(self, query_results, lon, lat):
+        """Samples the query's native products at WGS84 points.
+
+        Returns {quantity: values}, one value per point, read from the
+        products in their native projection and resolution so nothing is
+        reprojected. Later products overwrite earlier ones, as in a mosaic.
+        Points no product covers hold the band's nodata value, or 0.
+        """
+        lon = np.asarray(lon, dtype=np.float64).ravel()
+        lat = np.asarray(lat, dtype=np.float64).ravel()
+        coords = {}
+        results = {}
+        for tile, quantity, measurements in query_results['results']:
+            for (res, proj, native, path) in measurements:
+                if not native:
+                    continue
+                if proj not in coords:
+                    coords[proj] = TransformCoords(lon, lat, f'EPSG:{proj}')
+                if quantity not in results:
+                    dtype, nodata = RasterType(path)
+                    results[quantity] = np.full(len(lon), nodata, dtype=dtype)
+                inside, values = ReadPoints(gdal.Open(path), *coords[proj])
+                results[quantity][inside] = values
+        return(results)
+
+    def BuildPolygon(self, query_results, rings, projection, resolution):
+        """Mosaics the query's products inside a polygon given as rings of (lon, lat) vertices, the exterior first and then any holes.
+
+        The grid is the polygon's bounding box in `projection`. Only the part
+        of each product window that meets the polygon is read. If `virtual`
+        is set, the native products are warped straight onto the part of the
+        grid that meets the polygon instead of being reprojected to files.
+        Returns {quantity: masked array}, masked outside the polygon.
+        """
+        projected = [np.stack(TransformCoords(ring[:,0], ring[:,1], projection), axis=1) for ring in (np.asarray(ring, dtype=np.float64) for ring in rings)]
+        vertices = np.concatenate(projected)
+        lb = (vertices[:,0].min(), vertices[:,1].min())
+        ub = (vertices[:,0].max(), vertices[:,1].max())
+        width = int(abs(lb[0] - ub[0]) / resolution)
+        height = int(abs(lb[1] - ub[1]) / resolution)
+        mask = PolygonMask(projected, lb[0], ub[1] + resolution, width, height, resolution)
+        results = {}
+        if self.virtual:
+            rows = np.flatnonzero(mask.any(axis=1))
+            cols = np.flatnonzero(mask.any(axis=0))
+            if not len(rows):
+                return({})
+            r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            inside = mask[r0:r1, c0:c1]
+            for quantity, groups in self.NativeSources(query_results['results']).items():
+                for proj, paths in groups.items():
+                    for path in paths:
+                        self.EnsureOverviews(path, projection, resolution)
+                    subset, nodata = WarpGrid(paths, projection, resolution, lb[0] + c0 * resolution, ub[1] + resolution - r0 * resolution,
+                                              int(c1 - c0), int(r1 - r0))
+                    if quantity not in results:
+                        results[quantity] = np.zeros((height, width), dtype=subset.dtype)
+                    # Later projections win where they have data, as in BuildVirtualResult().
+                    valid = inside & (subset != nodata)
+                    results[quantity][r0:r1, c0:c1][valid] = subset[valid]
+            return({quantity: np.ma.masked_array(result, mask=~mask) for quantity, result in results.items()})
+        for tile, quantity, proj_file in self.ProjectProducts(query_results, projection, resolution):
+            dat = gdal.Open(proj_file)
+            offset, size, ret_offset = self.SubsetWindow(dat, lb, ub, resolution)
+            if size[0] <= 0 or size[1] <= 0:
+                continue
+            window = mask[ret_offset[1]:ret_offset[1]+size[1], ret_offset[0]:ret_offset[0]+size[0]]
+            rows = np.flatnonzero(window.any(axis=1))
+            cols = np.flatnonzero(window.any(axis=0))
+            if not len(rows):
+                continue
+            r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            subset = dat.ReadAsArray(xoff = int(offset[0] + c0), yoff = int(offset[1] + r0), xsize = int(c1 - c0), ysize = int(r1 - r0))
+            if quantity not in results:
+                results[quantity] = np.zeros((height, width), dtype=subset.dtype)
+            inside = window[r0:r1, c0:c1]
+            results[quantity][ret_offset[1]+r0:ret_offset[1]+r1, ret_offset[0]+c0:ret_offset[0]+c1][inside] = subset[inside]
+        self.cache.Evict()
+        return({quantity: np.ma.masked_array(result, mask=~mask) for quantity, result in results.items()})
+
+    def BuildMany(self, queries, projection, resolution):
+        """Fetches and mosaics the products of several queries, doing the work they share once.
+
+        `queries` is a list of (query_results, lon1, lat1, lon2, lat2). A
+        product used by several queries is downloaded, reprojected and opened
+        once, and the windows all of them need are read from it together
+        when they are close, see ReadWindows().
+        Yields (index, results) for each query as soon as the last product it
+        uses has been read, so results arrive in completion order.
+        """
+        merged = None
+        unique = {}
+        keys = []
+        for query_results, lon1, lat1, lon2, lat2 in queries:
+            if merged is None:
+                merged = dict(query_results, results = [], dates = [])
+            query_keys = []
+            for (tile, quantity, measurements), date in zip(query_results['results'], query_results['dates']):
+                key = (tile, quantity, date)
+                if key not in unique:
+                    unique[key] = len(merged['results'])
+                    merged['results'].append((tile, quantity, measurements))
+                    merged['dates'].append(date)
+                query_keys.append(key)
+            keys.append(query_keys)
+        if merged is None:
+            return
+        with Measure('get_products'):
+            self.GetProducts(merged)
+        if self.virtual:
+            for i, (query_results, lon1, lat1, lon2, lat2) in enumerate(queries):
+                yield(i, self.BuildResult(query_results, lon1, lat1, lon2, lat2, projection, resolution))
+            return
+        projected = self.ProjectProducts(merged, projection, resolution)
+        proj_files = {key: projected[i][2] for key, i in unique.items()}
+        grids = []
+        for query_results, lon1, lat1, lon2, lat2 in queries:
+            grids.append((GetSRCoord(lon1, lat1, projection), GetSRCoord(lon2, lat2, projection)))
+        # Files in the order the queries first need them, and the queries that read each one.
+        readers = {}
+        pending = []
+        for i, query_keys in enumerate(keys):
+            pending.append({proj_files[key] for key in query_keys})
+            for key in query_keys:
+                readers.setdefault(proj_files[key], set()).add(i)
+        subsets = [{} for query in queries]
+        for i in range(len(queries)):
+            if not pending[i]:
+                yield(i, {})
+        for proj_file, indices in readers.items():
+            dat = gdal.Open(proj_file)
+            windows = {}
+            for i in indices:
+                offset, size, ret_offset = self.SubsetWindow(dat, grids[i][0], grids[i][1], resolution)
+                if size[0] > 0 and size[1] > 0:
+                    windows[i] = (offset, size, ret_offset)
+            for i, subset in self.ReadWindows(dat, windows).items():
+                subsets[i][proj_file] = (subset, windows[i][2])
+            for i in indices:
+                pending[i].discard(proj_file)
+                if not pending[i]:
+                    yield(i, self.AssembleResult(keys[i], proj_files, subsets[i], grids[i][0], grids[i][1], resolution))
+                    subsets[i] = None
+        self.cache.Evict()
+
+    def ReadWindows(self, dat, windows):
+        """Reads the {index: (offset, size, ret_offset)} `windows` of `dat`, returning {index: array}.
+
+        Overlapping windows are read in one read of their union, unless the
+        union is more than UNION_READ_RATIO times their total area, as for
+        scattered AOIs. Each window is copied out of the union, so the union
+        is freed as soon as the windows are read.
+        """
+        if not windows:
+            return({})
+        x0 = min(offset[0] for offset, size, ret_offset in windows.values())
+        y0 = min(offset[1] for offset, size, ret_offset in windows.values())
+        x1 = max(offset[0] + size[0] for offset, size, ret_offset in windows.values())
+        y1 = max(offset[1] + size[1] for offset, size, ret_offset in windows.values())
+        if (x1 - x0) * (y1 - y0) > UNION_READ_RATIO * sum(size[0] * size[1] for offset, size, ret_offset in windows.values()):
+            return({i: dat.ReadAsArray(xoff = offset[0], yoff = offset[1], xsize = size[0], ysize = size[1])
+                    for i, (offset, size, ret_offset) in windows.items()})
+        block = dat.ReadAsArray(xoff = x0, yoff = y0, xsize = x1 - x0, ysize = y1 - y0)
+        return({i: block[offset[1]-y0:offset[1]-y0+size[1], offset[0]-x0:offset[0]-x0+size[0]].copy()
+                for i, (offset, size, ret_offset) in windows.items()})
+
+    def AssembleResult(self, keys, proj_files, subsets, lb, ub, resolution):
+        """Mosaics the subsets read for one query of BuildMany() the way BuildResult() does."""
+        width = int(abs(lb[0] - ub[0]) / resolution)
+        height = int(abs(lb[1] - ub[1]) / resolution)
+        results = {}
+        for tile, quantity, date in keys:
+            if proj_files[(tile, quantity, date)] not in subsets:
+                continue
+            subset, offset = subsets[proj_files[(tile, quantity, date)]]
+            if quantity not in results:
+                results[quantity] = np.ndarray((height, width), dtype=subset.dtype)
+                results[quantity].fill(0)
+            results[quantity][offset[1]:offset[1]+subset.shape[0], offset[0]:offset[0]+subset.shape[1]] = subset
+        return(results)
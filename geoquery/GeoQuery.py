@@ -1,501 +1,197 @@
-import osfclient
-from geojson import Polygon
-from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
 import mgrs
-from osgeo import gdal,ogr,osr
-from datetime import date
-from zipfile import ZipFile
-from dateutil import parser
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import asyncio
 import numpy as np
-import pickle
-import atexit
 import sys
-import os
 
-def char_range(c1, c2):
-    """Generates the characters from `c1` to `c2`, inclusive."""
-    for c in range(ord(c1), ord(c2)+1):
-        yield chr(c)
-
-def GetTile(name):
-    metadata = f.split('.')
-    if metadata[-1] == 'tif' or metadata[-1] == 'tiff':
-        tile = metadata[2][1:]
-        return(tile[0:-2], tile[-2:])
-    else:
-        return(None, None)
-
-def CalcMGRSIdx():
-    tile_column = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z']
-    tile_row = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'U', 'V']
-
-    m = mgrs.MGRS()
-    mgrs_idx = {}
-    for first in range(1, 61):
-        for second in char_range('A', 'Z'):
-            mgrs_idx[(first, second)] = {}
-            tiles = []
-            found_col = []
-            found_row = []
-            for third in tile_column:
-                for fourth in tile_row:
-                    mgrs_str = f'{first}{second}{third}{fourth}'
-                    try:
-                        latlon = m.toLatLon(mgrs_str)
-                        tiles.append((third, fourth))
-                        found_col.append(third)
-                        found_row.append(fourth)
-                    except Exception:
-                        pass 
-            low_col = None
-            low_row = None
-            if not tiles:
-                continue
-            if 'Z' not in found_col:
-                low_col = found_col[0]
-            else:
-                gap = False
-                for col in tile_column:
-                    if col not in found_col:
-                        gap = True
-                    else:
-                        if gap:
-                            low_col = col
-                            break
-            if 'Z' not in found_row:
-                low_row = found_row[0]
-            else:
-                gap = False
-                for row in tile_row:
-                    if row not in found_row:
-                        gap = True
-                    else:
-                        if gap:
-                            low_row = row
-                            break
-            for tile in tiles:
-                coffset = ord(tile[0]) - ord(low_col)
-                if coffset < 0:
-                    coffset = coffset + len(tile_column)
-                roffset = ord(tile[1]) - ord(low_row)
-                if roffset < 0:
-                    roffset = roffset + len(tile_row)
-                mgrs_idx[(first, second)][tile] = (coffset, roffset)
-    return(mgrs_idx) 
-
-def GetSRCoord(lon, lat, projection):
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(4326)
-
-    target = osr.SpatialReference()
-    if projection.startswith("EPSG"):
-        ignored, epsg = projection.split(":")
-        target.ImportFromEPSG(int(epsg))
-    else:
-        raise ValueError(f"unsupported projection: {projection}")
-
-    transform = osr.CoordinateTransformation(source, target)
-    point = ogr.CreateGeometryFromWkt(f"POINT ({lat} {lon})")
-    point.Transform(transform)
-
-    ignored, xcoord, ycoord = str(point).split(' ')
-    xcoord = xcoord.replace('(','')
-    ycoord = ycoord.replace(')','')
-    return((float(xcoord), float(ycoord)))
-
-def MGRStoTuple(m):
-    return(int(m[0:2]), m[2], m[3], m[4], m[5:])
-
-class SentinelBoxQuery:
-    def __init__(self, api, target, lon1, lat1, lon2, lat2, sdate, edate):
-        self.api = api
-        box = Polygon([[(lon1, lat1), (lon2, lat1), (lon2, lat2), (lon1, lat2), (lon1, lat1)]])
-        self.footprint = geojson_to_wkt(box)
-        self.date = (sdate, edate)
-        self.args = {}
-        try:
-            ignored, argpart = target.split('^')
-            args = argpart.split(',')
-            for arg in args:
-                key, value = arg.split('=')
-                self.args[key] = value
-        except ValueError:
-            pass
-
-    def GetProductList(self):
-        self.products = self.api.query(self.footprint, date=self.date, producttype=self.args['product'], instrumentshortname=self.args['instrument'])
-        return(self.products)
-
-class EarthDataBoxQuery:
-    def __init__(self, api, target, lon1, lat1, lon2, lat2, sdate, edate):
-        self.api = api
-        m = mgrs.MGRS()
-        bl = m.toMGRS(min(lat1, lat2), min(lon1, lon2), MGRSPrecision = 0)
-        tr = m.toMGRS(max(lat1, lat2), max(lon1, lon2), MGRSPrecision = 0)
-        self.bl = MGRStoTuple(bl)
-        self.tr = MGRStoTuple(tr)
-        self.sdate = parser.isoparse(sdate)
-        self.edate = parser.isoparse(edate)
-        try:
-            self.var, ignored = target.split('^')
-        except ValueError:
-            self.var = target
-        self.var = self.var.upper()
-    def GetProductList(self):
-        self.products = self.api.Query(self.bl, self.tr, self.sdate, self.edate, self.var)
-        return(self.products)
-
-class EarthDataOSFAccess:
-    def __init__(self, directory):
-        self.project = directory
-        self.osf = osfclient.OSF()
-        self.mdb = CalcMGRSIdx()
-        self.db = {}
-        p = self.osf.project(self.project)
-        for s in p.storages:
-            for f in s.files:
-                fname = f.path
-                fparts = fname.split('/')
-                if len(fparts) == 4:
-                    first = fparts[1]
-                    second = fparts[2]
-                    metadata = fparts[3].split('.')
-                    if metadata[-1] == 'tif' or metadata[-1] == 'tiff':
-                        var = metadata[0].upper()
-                        tile = metadata[2][1:]
-                        quant = metadata[6]
-                        if var not in self.db:
-                            self.db[var] = {}
-                        date = parser.isoparse(metadata[3])
-                        if tile not in self.db[var]:
-                            self.db[var][tile] = {}
-                        if quant not in self.db[var][tile]:
-                            self.db[var][tile][quant] = {}
-                        if date not in self.db[var][tile][quant]:
-                            self.db[var][tile][quant][date] = []
-                        self.db[var][tile][quant][date].append((-1, '', True, f))
-
-    def FindIntermediateTiles(self, bl, tr):
-        results = []
-        bl_offset = self.mdb[(bl[0], bl[1])][(bl[2], bl[3])]
-        tr_offset  = self.mdb[(tr[0], tr[1])][(tr[2], tr[3])]
-        for first in range(bl[0], tr[0] + 1):
-            for second in char_range(bl[1], tr[1]):
-                tiles = self.mdb[(first, second)]
-                for tile in tiles:
-                    tile_offset = tiles[tile]
-                    if (first == bl[0] and tile_offset[0] < bl_offset[0]) or (second == bl[1] and tile_offset[1] < bl_offset[1]):
-                        continue
-                    elif (first == tr[0] and tile_offset[0] > tr_offset[0]) or (second == tr[1] and tile_offset[1] > tr_offset[1]):
-                        continue
-                    results.append((first, second, tile[0], tile[1]))
-        return(results)
-
-    def Query(self, bl, tr, sdate, edate, var):
-        results = []
-        tiles_between = self.FindIntermediateTiles(bl, tr)
-        for tile in tiles_between:
-            tile_str = f'{tile[0]:02d}{tile[1]}{tile[2]}{tile[3]}'
-            if tile_str in self.db[var]:
-                for quantity in self.db[var][tile_str]:
-                    for date in self.db[var][tile_str][quantity]:
-                        if sdate <= date and edate >= date:
-                            results.append((tile, quantity, self.db[var][tile_str][quantity][date]))
-                            break
-        return({'var': var, 'project': self.project, 'results': results})
-
-class EarthDataLocalAccess:
-    def __init__(self, directory):
-        self.dir = directory
-        self.mdb = CalcMGRSIdx()
-        self.db = {}
-        for first in os.listdir(self.dir):
-            firstf = f'{directory}/{first}'
-            if os.path.isdir(firstf):
-                for second in os.listdir(firstf): 
-                    secondf = f'{firstf}/{second}'
-                    if os.path.isdir(secondf):
-                        for file in os.listdir(secondf):
-                            path = f'{secondf}/{file}'
-                            metadata = file.split('.')
-                            if metadata[-1] == 'tif' or metadata[-1] == 'tiff':
-                                var = metadata[0].upper()
-                                tile = metadata[2][1:]
-                                quant = metadata[6]
-                                dat = gdal.Open(path)
-                                if(len(metadata) < 9):
-                                    geo = dat.GetGeoTransform()
-                                    res = geo[1]
-                                    native = True
-                                else:
-                                    res = metadata[7]
-                                    native = False
-                                ref = dat.GetSpatialRef()
-                                proj = ref.GetAuthorityCode('PROJCS')
-                                if var not in self.db:
-                                    self.db[var] = {}
-                                date = parser.isoparse(metadata[3])
-                                if tile not in self.db[var]:
-                                    self.db[var][tile] = {}
-                                if quant not in self.db[var][tile]:
-                                    self.db[var][tile][quant] = {}
-                                if date not in self.db[var][tile][quant]:
-                                    self.db[var][tile][quant][date] = []
-                                self.db[var][tile][quant][date].append((res, proj, native, path))
-                            
-    def FindIntermediateTiles(self, bl, tr):
-        results = []
-        bl_offset = self.mdb[(bl[0], bl[1])][(bl[2], bl[3])]
-        tr_offset  = self.mdb[(tr[0], tr[1])][(tr[2], tr[3])]
-        for first in range(bl[0], tr[0] + 1):
-            for second in char_range(bl[1], tr[1]):
-                tiles = self.mdb[(first, second)]
-                for tile in tiles:
-                    tile_offset = tiles[tile]
-                    if (first == bl[0] and tile_offset[0] < bl_offset[0]) or (second == bl[1] and tile_offset[1] < bl_offset[1]):
-                        continue
-                    elif (first == tr[0] and tile_offset[0] > tr_offset[0]) or (second == tr[1] and tile_offset[1] > tr_offset[1]):
-                        continue
-                    results.append((first, second, tile[0], tile[1]))
-        return(results)
-
-    def Query(self, bl, tr, sdate, edate, var):
-        results = []
-        tiles_between = self.FindIntermediateTiles(bl, tr)
-        for tile in tiles_between:
-            tile_str = f'{tile[0]:02d}{tile[1]}{tile[2]}{tile[3]}'
-            if tile_str in self.db[var]:
-                for quantity in self.db[var][tile_str]:
-                    for date in self.db[var][tile_str][quantity]:
-                        if sdate <= date and edate >= date:
-                            results.append((tile, quantity, self.db[var][tile_str][quantity][date]))
-                            break
-        return({'var': var, 'results': results})
-
-class EarthDataAdapter:
-
-    def __init__(self, directory, provider = 'local'):
-        self.dir = directory
-        self.provider = provider
-        if provider == 'local':
-            self.api = EarthDataLocalAccess(self.dir)
-        elif provider == 'osf':
-            self.api = EarthDataOSFAccess(self.dir)
-        else:
-            raise ValueError(f"unknown provider: {provider}")
-    
-    def CreateQuery(self, target, lon1, lat1, lon2, lat2, sdate, edate):
-        return(EarthDataBoxQuery(self.api, target, lon1, lat1, lon2, lat2, sdate, edate))
-
-    def GetProducts(self, query_result):
-        if self.provider == 'osf':
-            project = query_result['project']
-            products = query_result['results']
-            if not os.path.exists(project):
-                os.mkdir(project)
-            if not os.path.isdir(project):
-                raise FileExistsError(f'{project} exists, but is not a directory!')
-            for tile, quantity, measurements in products:
-                dl_products = []
-                for (ignored, ignored, ignored, file) in measurements:
-                    inner = f'{project}/{tile[0]}{tile[1]}'
-                    outer = f'{inner}/{tile[2]}{tile[3]}'
-                    if not os.path.exists(inner):
-                         os.mkdir(inner)
-                    if not os.path.isdir(inner):
-                        raise FileExistsError(f'{inner} exists, but is not a directory!')
-                    if not os.path.exists(outer):
-                        os.mkdir(outer)
-                    if not os.path.isdir(outer):
-                        raise FileExistsError(f'{outer} exists, but is not a directory!')
-                    srcfile = file.path.split('/')[-1]
-                    tgtfile = f'{outer}/{srcfile}'
-                    if not os.path.exists(tgtfile):
-                        with open(tgtfile, 'wb') as fp:
-                            file.write_to(fp)
-                    dat = gdal.Open(tgtfile)
-                    geo = dat.GetGeoTransform()
-                    res = geo[1]
-                    native = True
-                    ref = dat.GetSpatialRef()
-                    proj = ref.GetAuthorityCode('PROJCS')
-                    dl_products.append((res, proj, native, tgtfile))
-                measurements.clear()
-                measurements.extend(dl_products)
-
-    def ProjectMeasurement(self, measurement, projection, resolution):
-        root_ext = os.path.splitext(measurement)
-        proj_file = f'{root_ext[0]}.{resolution}{root_ext[1]}'
-        if not os.path.exists(proj_file):
-            gdal.Warp(proj_file, measurement, dstSRS = projection, xRes = resolution, yRes = resolution)
-        return(proj_file)
-
-    def GetSubset(self, proj_file, projection, lb, ub, resolution):
-        dat = gdal.Open(proj_file)
-        geo = dat.GetGeoTransform()
-        xres = resolution
-        yres = -resolution
-        tl = (min(lb[0], ub[0]), max(lb[1], ub[1]) + resolution)
-        ret_offset = [0, 0]
-        size = [int(abs(ub[0] - lb[0]) / resolution), int(abs(ub[1] - lb[1]) / resolution)]
-        offset = [int((tl[0] - geo[0]) / xres), int((tl[1] - geo[3]) / yres)]
-        if offset[0] < 0:
-            size[0] = size[0] + offset[0]
-            ret_offset[0] = -offset[0]
-            offset[0] = 0
-        if offset[1] < 0:
-            size[1] = size[1] + offset[1]
-            ret_offset[1] = -offset[1]
-            offset[1] = 0
-        if (offset[0] + size[0]) > dat.RasterXSize:
-            size[0] = dat.RasterXSize - offset[0]
-        if (offset[1] + size[1]) > dat.RasterYSize:
-            size[1] = dat.RasterYSize - offset[1]
-        if size[0] > 0 and size[1] > 0:
-            arr = dat.ReadAsArray(xoff = offset[0], yoff = offset[1], xsize = size[0], ysize = size[1])
-        else:
-            arr = None
-        return arr, ret_offset
-
-
-    def BuildResult(self, query_results, lon1, lat1, lon2, lat2, projection, resolution):
-        lb = GetSRCoord(lon1, lat1, projection)
-        ub = GetSRCoord(lon2, lat2, projection)
-        width = int(abs(lb[0] - ub[0]) / resolution)
-        height = int(abs(lb[1] - ub[1]) / resolution)
-        results = {}
-        var = query_results['var']
-        products = query_results['results']
-        for tile, quantity, measurements in products:
-            proj_file = None
-            for (res, proj, native, path) in measurements:
-                if res == resolution and f'EPSG:{proj}' == projection:
-                    proj_file = path
-                elif native:
-                    to_reproj = path
-            if proj_file == None:
-                proj_file = self.ProjectMeasurement(to_reproj, projection, resolution)
-                path, file = os.path.split(proj_file)
-                metadata = file.split('.')
-                date = parser.isoparse(metadata[3])
-                tile_str = f'{tile[0]:02d}{tile[1]}{tile[2]}{tile[3]}'
-                self.api.db[var][tile_str][quantity][date].append((resolution, projection, False, proj_file))
-            subset, offset = self.GetSubset(proj_file, projection, lb, ub, resolution)
-            if not subset is None:
-                if quantity not in results:
-                    results[quantity] = np.ndarray((height, width), dtype=subset.dtype)
-                    results[quantity].fill(0)
-                results[quantity][offset[1]:offset[1]+subset.shape[0], offset[0]:offset[0]+subset.shape[1]] = subset
-        return(results)
-    
-def WriteSentinelDb(db):
-    with open(".sentineldb", "wb") as file:
-        pickle.dump(db, file)
-
-class SentinelAdapter:
-    def __init__(self):
-        username = os.getenv('DS_SENTINEL_USERNAME')
-        password = os.getenv('DS_SENTINEL_PWD')
-        self.api = SentinelAPI(username, password, 'https://apihub.copernicus.eu/apihub')
-        try:
-            with open(".sentineldb", "rb") as file:
-                self.db = pickle.load(file)
-        except FileNotFoundError:
-            self.db = {}
-        atexit.register(WriteSentinelDb, self.db)
-
-    def CreateQuery(self, target, lon1, lat1, lon2, lat2, sdate, edate):
-        return(SentinelBoxQuery(self.api, target, lon1, lat1, lon2, lat2, sdate, edate))
-
-    def GetProducts(self, products):
-        download_prod = {}
-        for product in products:
-            if product not in self.db:
-                download_prod[product] = products[product]
-        self.api.download_all(download_prod)
-        for product in download_prod:
-            self.db[product] = {"product": download_prod[product], "projections": {}}
-            zipf = download_prod[product]['title']
-            with ZipFile(f'{zipf}.zip', 'r') as zip_ref:
-                zip_ref.extractall(zipf)
-            measure_dir = f'{zipf}/{zipf}.SAFE/measurement/'
-            self.db[product]['measurements'] = [measure_dir+x for x in os.listdir(measure_dir)]
-
-    def ProjectMeasurement(self, measurement, projection, resolution):
-        root_ext = os.path.splitext(measurement)
-        proj_file = f'{root_ext[0]}_{projection}_{resolution}_{root_ext[1]}'
-        gdal.Warp(proj_file, measurement, dstSRS = projection, xRes = resolution, yRes = resolution)
-        return(proj_file)
-
-    def GetSubset(self, product, band, polarity, projection, lb, ub, resolution):
-        proj_file = self.db[product]['projections'][(band, polarity, projection, resolution)]
-        if self.db[product]['product']['orbitdirection'] == 'ASCENDING':
-            xres = resolution
-            yres = resolution
-        else:
-            xres = -resolution
-            yres = -resolution
-        tl = (min(lb[0], ub[0]), max(lb[1], ub[1]) + resolution)
-        dat = gdal.Open(proj_file)
-        geo = dat.GetGeoTransform()
-        ret_offset = [0, 0]
-        size = [int(abs(ub[0] - lb[0]) / resolution), int(abs(ub[1] - lb[1]) / resolution)]
-        offset = [int((tl[0] - geo[0]) / xres), int((tl[1] - geo[3]) / yres)]
-        if offset[0] < 0:
-            size[0] = size[0] + offset[0]
-            ret_offset[0] = -offset[0]
-            offset[0] = 0
-        if offset[1] < 0:
-            size[1] = size[1] + offset[1]
-            ret_offset[1] = -offset[1]
-            offset[1] = 0
-        if (offset[0] + size[0]) > dat.RasterXSize:
-            size[0] = dat.GetXSize() - offset[0]
-        if (offset[1] + size[1]) > dat.RasterYSize:
-            size[1] = dat.GetYSize() - offset[1]
-
-        if size[0] > 0 and size[1] > 0:
-            arr = dat.ReadAsArray(xoff = offset[0], yoff = offset[1], xsize = size[0], ysize = size[1])
-        else:
-            arr = None
-        return arr, ret_offset
-
-    def GetBandPolarity(self, filename):
-        fattrs = os.path.basename(filename).split('-')
-        return((fattrs[3], fattrs[1]))
-
-    def BuildResult(self, products, lon1, lat1, lon2, lat2, projection, resolution):
-        lb = GetSRCoord(lon1, lat1, projection)
-        ub = GetSRCoord(lon2, lat2, projection)
-        width = int(abs(lb[0] - ub[0]) / resolution)
-        height = int(abs(lb[1] - ub[1]) / resolution)
-        results = {}
-        for product in products:
-            for measurement in self.db[product]['measurements']:
-                (band, polarity) = self.GetBandPolarity(measurement)
-                if (band, polarity, projection, resolution) not in self.db[product]['projections']:
-                    self.db[product]['projections'][(band, polarity, projection, resolution)] = self.ProjectMeasurement(measurement, projection, resolution)
-                subset, offset = self.GetSubset(product, band, polarity, projection, lb, ub, resolution) 
-                if not subset is None:
-                    if not (band, polarity) in results:
-                        results[(band, polarity)] = np.ndarray((height, width), dtype=subset.dtype)
-                        results[(band, polarity)].fill(np.nan)
-                    results[(band, polarity)][offset[1]:offset[1]+subset.shape[0], offset[0]:offset[0]+subset.shape[1]] = subset
-        return(results)
+from .Instrumentation import Measure, QueryScope, Bind
+# The adapters and raster helpers were defined in this module before they got
+# modules of their own; they are imported here so existing imports keep working.
+from .Raster import (SpatialRef, GetTransformer, TransformCoords, GetSRCoord, WarpToFile, BuildOverviews, RESULT_GTIFF_OPTIONS,
+                     WarpWindow, WarpGrid, RasterType, ReadWindowRows, WarpRows, ReadPoints, PolygonMask, MosaicWriter)
+from .EarthData import (GetTile, MGRStoTuple, EarthDataBoxQuery, EarthDataOSFAccess, ScanLocalMeasurement, EarthDataLocalAccess,
+                        EarthDataAdapter)
+from .Sentinel import SENTINEL_EXTRACT_MODES, SentinelSelection, SentinelBoxQuery, ImportSentinelDb, SentinelAdapter
 
 class GeoInterface:
-    def __init__(self):
+    def __init__(self, executor = None):
         self.adapters = {}
+        # Runs the blocking steps of AsyncQuery(); None is the event loop's default executor.
+        self.executor = executor
     def AddAdapter(self, name, adapter):
         self.adapters[name] = adapter
     def CreateQuery(self, adapter, target, lon1, lat1, lon2, lat2, sdate, edate):
         return(adapter.CreateQuery(target, lon1, lat1, lon2, lat2, sdate, edate))
-    def Query(self, target, lon1, lat1, lon2, lat2, sdate, edate, projection, resolution):
+    def Query(self, target, lon1, lat1, lon2, lat2, sdate, edate, projection, resolution, output = None):
+        with QueryScope(target):
+            adapter = self.FindAdapter(target)
+            with Measure('product_list'):
+                query = self.CreateQuery(adapter, target, lon1, lat1, lon2, lat2, sdate, edate)
+                products = query.GetProductList()
+            with Measure('get_products'):
+                adapter.GetProducts(products)
+            with Measure('build'):
+                return(adapter.BuildResult(products, lon1, lat1, lon2, lat2, projection, resolution, output = output))
+
+    def FusedQuery(self, targets, lon1, lat1, lon2, lat2, sdate, edate, projection, resolution, dtype = None):
+        """Runs Query() on every target in `targets` at once and stacks the results on their shared grid.
+
+        Returns (stack, bands). `stack` is a (band, y, x) array and bands[i]
+        is the (target, key) pair stack[i] came from, `key` being the
+        adapter's result key. The stack has `dtype`, by default the smallest
+        type that holds every band.
+        """
+        lb = GetSRCoord(lon1, lat1, projection)
+        ub = GetSRCoord(lon2, lat2, projection)
+        shape = (int(abs(lb[1] - ub[1]) / resolution), int(abs(lb[0] - ub[0]) / resolution))
+        with ThreadPoolExecutor(len(targets)) as pool:
+            futures = [pool.submit(self.Query, target, lon1, lat1, lon2, lat2, sdate, edate, projection, resolution) for target in targets]
+            results = [future.result() for future in futures]
+        bands = []
+        arrays = []
+        for target, result in zip(targets, results):
+            for key, array in result.items():
+                if array.shape != shape:
+                    raise ValueError(f'{target}: {key} has shape {array.shape}, expected {shape}')
+                bands.append((target, key))
+                arrays.append(array)
+        if dtype is None:
+            dtype = np.result_type(*arrays) if arrays else np.float32
+        stack = np.empty((len(arrays),) + shape, dtype = dtype)
+        for i, array in enumerate(arrays):
+            stack[i] = array
+        return(stack, bands)
+
+    async def AsyncQuery(self, target, lon1, lat1, lon2, lat2, sdate, edate, projection, resolution, output = None):
+        """Coroutine version of Query().
+
+        Each step runs in `executor`, so the event loop is never blocked by a
+        catalog lookup, download or warp. Queries awaited together, e.g.
+        with asyncio.gather(), run concurrently, including queries on the same
+        adapter, which share downloads and reprojections that are in flight.
+        """
+        loop = asyncio.get_running_loop()
+        with QueryScope(target):
+            adapter = self.FindAdapter(target)
+            with Measure('product_list'):
+                query = await loop.run_in_executor(self.executor, Bind(self.CreateQuery), adapter, target, lon1, lat1, lon2, lat2, sdate, edate)
+                products = await loop.run_in_executor(self.executor, Bind(query.GetProductList))
+            with Measure('get_products'):
+                await loop.run_in_executor(self.executor, Bind(adapter.GetProducts), products)
+            with Measure('build'):
+                build = functools.partial(adapter.BuildResult, products, lon1, lat1, lon2, lat2, projection, resolution, output = output)
+                return(await loop.run_in_executor(self.executor, Bind(build)))
+
+    def QueryPoints(self, target, lons, lats, sdate, edate):
+        """Returns {quantity: values} with the value of each quantity at each of the WGS84 points (lons[i], lats[i]).
+
+        Only the tiles that hold a point are fetched, and only the blocks
+        around the points are read.
+        """
+        adapter = self.FindAdapter(target)
+        if not hasattr(adapter, 'SamplePoints'):
+            raise ValueError(f'{target}: adapter does not support point queries')
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        with QueryScope(target):
+            with Measure('product_list'):
+                query = self.CreateQuery(adapter, target, lons.min(), lats.min(), lons.max(), lats.max(), sdate, edate)
+                products = query.GetProductList()
+                m = mgrs.MGRS()
+                tiles = {MGRStoTuple(m.toMGRS(lat, lon, MGRSPrecision = 0))[:4] for lon, lat in zip(lons.tolist(), lats.tolist())}
+                products = dict(products, results = [result for result in products['results'] if result[0] in tiles],
+                                dates = [date for result, date in zip(products['results'], products['dates']) if result[0] in tiles])
+            with Measure('get_products'):
+                adapter.GetProducts(products)
+            with Measure('build'):
+                return(adapter.SamplePoints(products, lons, lats))
+
+    def QueryPolygon(self, target, polygon, sdate, edate, projection, resolution, holes = ()):
+        """Like Query(), for the area inside `polygon`, a list of (lon, lat) vertices, less any `holes` given the same way.
+
+        Returns {quantity: numpy.ma.MaskedArray} over the polygon's bounding
+        box, masked outside the polygon.
+        """
+        adapter = self.FindAdapter(target)
+        if not hasattr(adapter, 'BuildPolygon'):
+            raise ValueError(f'{target}: adapter does not support polygon queries')
+        vertices = np.asarray(polygon, dtype=np.float64)
+        with QueryScope(target):
+            with Measure('product_list'):
+                query = self.CreateQuery(adapter, target, vertices[:,0].min(), vertices[:,1].min(), vertices[:,0].max(), vertices[:,1].max(), sdate, edate)
+                products = query.GetProductList()
+            with Measure('get_products'):
+                adapter.GetProducts(products)
+            with Measure('build'):
+                return(adapter.BuildPolygon(products, [polygon, *holes], projection, resolution))
+
+    def QuerySeries(self, target, lon1, lat1, lon2, lat2, sdate, edate, projection, resolution, reduce = None):
+        """Like Query(), but keeps every date in [sdate, edate] as a (time, y, x) cube per quantity.
+
+        Unless the target sets the `dates` modifier, all dates are used. With
+        `reduce` ('latest', 'median', 'max' or 'count') the cubes are reduced
+        over time and 2-D arrays are returned.
+        """
         adapter = self.FindAdapter(target)
-        query = self.CreateQuery(adapter, target, lon1, lat1, lon2, lat2, sdate, edate)
-        products = query.GetProductList()
-        adapter.GetProducts(products)
-        return(adapter.BuildResult(products, lon1, lat1, lon2, lat2, projection, resolution))
+        if not hasattr(adapter, 'BuildSeries'):
+            raise ValueError(f'{target}: adapter does not support time series queries')
+        with QueryScope(target):
+            with Measure('product_list'):
+                query = self.CreateQuery(adapter, target, lon1, lat1, lon2, lat2, sdate, edate)
+                query.policy = query.args.get('dates', 'all')
+                products = query.GetProductList()
+            with Measure('get_products'):
+                adapter.GetProducts(products)
+            with Measure('build'):
+                return(adapter.BuildSeries(products, lon1, lat1, lon2, lat2, projection, resolution, reduce))
+
+    def QueryMany(self, target, aois, projection, resolution):
+        """Runs Query() for every (lon1, lat1, lon2, lat2, sdate, edate) in `aois`, sharing the work they have in common.
+
+        Returns a generator of (index, results) pairs, where `index` is the
+        position of the area in `aois`. Results are yielded as they complete,
+        which need not be in the order of `aois`.
+        """
+        adapter = self.FindAdapter(target)
+        scopes = []
+        queries = []
+        for lon1, lat1, lon2, lat2, sdate, edate in aois:
+            scope = QueryScope(target).Start()
+            with scope.Resume(), Measure('product_list'):
+                query = self.CreateQuery(adapter, target, lon1, lat1, lon2, lat2, sdate, edate)
+                queries.append((query.GetProductList(), lon1, lat1, lon2, lat2))
+            scopes.append(scope)
+        return(self.ScopedResults(adapter.BuildMany(queries, projection, resolution), scopes))
+
+    def ScopedResults(self, results, scopes):
+        """Yields the (index, results) pairs of a BuildMany() generator, ending the query scope of each area with its result.
+
+        Each area's `build` stage lasts until its result is ready. Work that
+        several areas share is done once, and counted in the scope of the
+        first area still waiting for its result.
+        """
+        builds = [Measure('build').__enter__() for scope in scopes]
+        waiting = dict(enumerate(scopes))
+        error = None
+        try:
+            while waiting:
+                with next(iter(waiting.values())).Resume():
+                    try:
+                        i, result = next(results)
+                    except StopIteration:
+                        break
+                scope = waiting.pop(i)
+                with scope.Resume():
+                    builds[i].__exit__(None, None, None)
+                scope.End()
+                yield(i, result)
+        except Exception as e:
+            error = type(e)
+            raise
+        finally:
+            for scope in waiting.values():
+                scope.End(error)
 
     def FindAdapter(self, target):
         try:
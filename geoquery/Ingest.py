@@ -0,0 +1,190 @@
+from osgeo import gdal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import shutil
+import errno
+import sys
+import os
+
+from .Catalog import LocalCatalog
+from .EarthData import GetTile, MeasurementKey
+from .Storage import TempPath
+
+INGEST_MODES = ('copy', 'hardlink', 'reflink')
+# ioctl that clones a file's extents on Linux (btrfs, XFS, ...).
+FICLONE = 0x40049409
+
+class IngestError(Exception):
+    pass
+
+def ReadHeader(path, metadata):
+    """Validates the GeoTIFF header of `path` and returns the (res, proj, native) that EarthDataLocalAccess catalogs for it."""
+    try:
+        dat = gdal.Open(path)
+    except RuntimeError as e:
+        raise IngestError(f'{path}: {e}')
+    if dat is None:
+        raise IngestError(f'{path}: {gdal.GetLastErrorMsg() or "not readable by GDAL"}')
+    if dat.GetDriver().ShortName != 'GTiff':
+        raise IngestError(f'{path}: not a GeoTIFF')
+    if dat.RasterCount < 1 or dat.RasterXSize < 1 or dat.RasterYSize < 1:
+        raise IngestError(f'{path}: no raster data')
+    geo = dat.GetGeoTransform(can_return_null = True)
+    if geo is None or geo[1] <= 0:
+        raise IngestError(f'{path}: no geotransform')
+    ref = dat.GetSpatialRef()
+    proj = None if ref is None else ref.GetAuthorityCode('PROJCS')
+    if proj is None:
+        raise IngestError(f'{path}: no projected EPSG code')
+    if len(metadata) < 9:
+        return(geo[1], proj, True)
+    return(metadata[7], proj, False)
+
+def Reflink(src, dst):
+    """Clones `src` to `dst` without copying data, or copies it where the filesystem cannot."""
+    try:
+        import fcntl
+        with open(src, 'rb') as source, open(dst, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        shutil.copystat(src, dst)
+    except (ImportError, OSError):
+        shutil.copy2(src, dst)
+
+def Transfer(src, dst, mode):
+    if mode == 'copy':
+        shutil.copy2(src, dst)
+    elif mode == 'hardlink':
+        os.link(src, dst)
+    else:
+        Reflink(src, dst)
+
+def IngestFile(src, directory, mode):
+    """Validates `src` and places it in `directory`'s tile tree under a temporary name.
+
+    Returns (row, tmp_file): the LocalCatalog row of the file's final path, and
+    the temporary file to move there once the row is committed, or None if
+    the file is already in place.
+    """
+    name = os.path.basename(src)
+    metadata = name.split('.')
+    if metadata[-1] != 'tif' and metadata[-1] != 'tiff':
+        raise IngestError(f'{src}: not a GeoTIFF')
+    try:
+        var, tile, quant, date = MeasurementKey(metadata)
+    except (IndexError, ValueError):
+        raise IngestError(f'{src}: not an HLS file name')
+    outer, inner = GetTile(name)
+    res, proj, native = ReadHeader(src, metadata)
+    outer = f'{directory}/{outer}/{inner}'
+    try:
+        os.makedirs(outer, exist_ok = True)
+    except FileExistsError:
+        raise IngestError(f'{outer} exists, but is not a directory')
+    dst = f'{outer}/{name}'
+    src_stat = os.stat(src)
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        dst_stat = None
+    if dst_stat is not None and (os.path.samestat(src_stat, dst_stat) or
+                                 (dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns == src_stat.st_mtime_ns)):
+        tmp_file = None
+        stat = dst_stat
+    else:
+        # Moved into place by Publish(), once the file's catalog row is committed.
+        tmp_file = TempPath(dst)
+        try:
+            Transfer(src, tmp_file, mode)
+            stat = os.stat(tmp_file)
+        except OSError as e:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            if e.errno == errno.EXDEV:
+                raise IngestError(f'{src}: cannot hard-link across filesystems')
+            raise IngestError(f'{src}: {e}')
+    return((dst, stat.st_mtime_ns, stat.st_size, var, tile, quant, date.isoformat(), res, proj, native), tmp_file)
+
+def Publish(catalog, pending):
+    """Commits the catalog rows of `pending` and then moves their files into place, so queries never open them to scan them."""
+    catalog.Update([row for row, ignored in pending])
+    for row, tmp_file in pending:
+        if tmp_file is not None:
+            os.replace(tmp_file, row[0])
+    pending.clear()
+
+def IngestFiles(sources, directory, mode = 'copy', workers = 8, catalog = None, batch = 100):
+    """Adds HLS GeoTIFFs to an EarthData directory tree and records them in its catalog.
+
+    Up to `workers` files are validated and copied, hard-linked or
+    reflinked (`mode`, see INGEST_MODES) at once. 'reflink' copies where
+    the filesystem cannot clone. Each file's catalog row is committed, in
+    batches of `batch`, before the file appears under its final name, so an
+    EarthDataLocalAccess on `directory` picks it up on its next refresh
+    without opening it. Paths are recorded as `<directory>/<zone><band>/<column><row>/<name>`
+    with `directory` normalized as EarthDataLocalAccess does, so it must
+    name the same relative or absolute path as the adapter's. Files
+    already in place are only recorded. Returns the paths of the ingested
+    files, and a message for each file that was rejected.
+    """
+    if mode not in INGEST_MODES:
+        raise ValueError(f'unknown ingest mode: {mode}')
+    directory = os.path.normpath(directory)
+    if catalog is None:
+        catalog = f'{directory}/.geoquery_catalog.sqlite'
+    os.makedirs(directory, exist_ok = True)
+    catalog = LocalCatalog(catalog)
+    ingested = []
+    errors = []
+    pending = []
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(IngestFile, src, directory, mode) for src in sources]
+            for future in as_completed(futures):
+                try:
+                    row, tmp_file = future.result()
+                except IngestError as e:
+                    errors.append(str(e))
+                    continue
+                pending.append((row, tmp_file))
+                ingested.append(row[0])
+                if len(pending) >= batch:
+                    Publish(catalog, pending)
+        Publish(catalog, pending)
+    finally:
+        for row, tmp_file in pending:
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        catalog.Close()
+    return(ingested, errors)
+
+def ListSources(paths, recursive = False):
+    """Expands the directories among `paths` into the GeoTIFFs they contain."""
+    sources = []
+    for path in paths:
+        if not os.path.isdir(path):
+            sources.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            sources.extend(os.path.join(root, name) for name in sorted(files) if name.split('.')[-1] in ('tif', 'tiff'))
+            if not recursive:
+                break
+    return(sources)
+
+def Main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Add HLS GeoTIFFs to an EarthData directory tree and its catalog.')
+    parser.add_argument('sources', nargs = '+', help = 'GeoTIFF files, or directories of them')
+    parser.add_argument('directory', help = 'EarthData directory, as given to EarthDataAdapter')
+    parser.add_argument('--mode', choices = INGEST_MODES, default = 'copy')
+    parser.add_argument('--workers', type = int, default = 8)
+    parser.add_argument('--catalog', help = 'catalog file, by default <directory>/.geoquery_catalog.sqlite')
+    parser.add_argument('--recursive', action = 'store_true', help = 'also ingest the GeoTIFFs in subdirectories of the sources')
+    args = parser.parse_args(argv)
+    ingested, errors = IngestFiles(ListSources(args.sources, args.recursive), args.directory, args.mode, args.workers, args.catalog)
+    for error in errors:
+        print(error, file=sys.stderr)
+    print(f'Ingested {len(ingested)} files into {args.directory}')
+    if errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,181 @@
+import contextvars
+import contextlib
+import itertools
+import threading
+import logging
+import json
+import time
+
+# Callables that receive every event; instrumentation is off while this is empty.
+_hooks = []
+_query = contextvars.ContextVar('geoquery_query', default = None)
+_query_ids = itertools.count(1)
+
+def AddHook(hook):
+    """Calls `hook(event)` for every event from now on. Events are dicts; see Stage and QueryScope."""
+    _hooks.append(hook)
+
+def RemoveHook(hook):
+    _hooks.remove(hook)
+
+def Emit(event):
+    query = _query.get()
+    if query is not None:
+        event['query'] = query.id
+        event['adapter'] = query.adapter
+        query.Add(event)
+    for hook in list(_hooks):
+        hook(event)
+
+class NullStage:
+    """Stands in for a Stage while no hook is registered, so disabled instrumentation costs one check."""
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        return(False)
+
+    def Add(self, **counters):
+        pass
+
+NULL_STAGE = NullStage()
+
+class Stage:
+    """Times a block of work and emits {'event': 'stage', 'stage', 'seconds', ...counters} when it ends.
+
+    Counters are numbers such as `bytes_read`, `bytes_written`, `tiles`,
+    `cache_hits` and `cache_misses`, given up front or added with Add().
+    """
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = counters
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return(self)
+
+    def __exit__(self, *exc):
+        event = {'event': 'stage', 'stage': self.name, 'seconds': time.perf_counter() - self.start}
+        event.update(self.counters)
+        if exc[0] is not None:
+            event['error'] = exc[0].__name__
+        Emit(event)
+        return(False)
+
+    def Add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+def Measure(stage, **counters):
+    """Returns a context manager timing `stage`, or NULL_STAGE if no hook is registered."""
+    if not _hooks:
+        return(NULL_STAGE)
+    return(Stage(stage, counters))
+
+def Record(stage, **counters):
+    """Emits the counters of `stage` without timing anything."""
+    if _hooks:
+        event = {'event': 'stage', 'stage': stage, 'seconds': 0.0}
+        event.update(counters)
+        Emit(event)
+
+class QueryStats:
+    def __init__(self, target, adapter):
+        self.id = next(_query_ids)
+        self.target = target
+        self.adapter = adapter
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def Add(self, event):
+        with self.lock:
+            totals = self.stages.setdefault(event['stage'], {'calls': 0})
+            totals['calls'] += 1
+            for key, value in event.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) and key != 'query':
+                    totals[key] = totals.get(key, 0) + value
+
+class QueryScope:
+    """Attributes the events emitted inside it, also from worker threads started through Bind(), to one query.
+
+    On exit it emits {'event': 'query', 'query', 'target', 'adapter',
+    'seconds', 'stages'}, where `stages` sums the calls, time and counters
+    of every stage of the query. A query whose work is interleaved with
+    others', such as an area of QueryMany(), is begun with Start(), made
+    current with Resume() for each piece of its work, and closed with End().
+    """
+    def __init__(self, target):
+        self.target = target
+        self.stats = None
+        self.token = None
+
+    def __enter__(self):
+        self.Start()
+        if self.stats is not None:
+            self.token = _query.set(self.stats)
+        return(self)
+
+    def __exit__(self, *exc):
+        if self.token is not None:
+            _query.reset(self.token)
+            self.token = None
+        self.End(exc[0])
+        return(False)
+
+    def Start(self):
+        if _hooks and self.stats is None:
+            self.stats = QueryStats(self.target, self.target.split('^')[0])
+            self.start = time.perf_counter()
+        return(self)
+
+    @contextlib.contextmanager
+    def Resume(self):
+        """Attributes the events emitted inside it to this query, without ending the query."""
+        if self.stats is None:
+            yield(self)
+            return
+        token = _query.set(self.stats)
+        try:
+            yield(self)
+        finally:
+            _query.reset(token)
+
+    def End(self, error = None):
+        """Emits the query event, once; `error` is the type of the exception that ended the query, if any."""
+        if self.stats is None:
+            return
+        event = {'event': 'query', 'query': self.stats.id, 'target': self.target, 'adapter': self.stats.adapter,
+                 'seconds': time.perf_counter() - self.start, 'stages': self.stats.stages}
+        if error is not None:
+            event['error'] = error.__name__
+        self.stats = None
+        for hook in list(_hooks):
+            hook(event)
+
+def Bind(fn):
+    """Returns `fn` bound to the current query, for running on another thread."""
+    query = _query.get()
+    if query is None:
+        return(fn)
+    def Run(*args, **kwargs):
+        token = _query.set(query)
+        try:
+            return(fn(*args, **kwargs))
+        finally:
+            _query.reset(token)
+    return(Run)
+
+class JSONExporter:
+    """Hook that writes each event as a line of JSON to `stream`, or logs it to the 'geoquery' logger at INFO level."""
+    def __init__(self, stream = None):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default = str)
+        if self.stream is None:
+            logging.getLogger('geoquery').info(line)
+        else:
+            with self.lock:
+                self.stream.write(line + '\n')
+                self.stream.flush()
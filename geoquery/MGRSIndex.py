@@ -0,0 +1,246 @@
+import mgrs
+import numpy as np
+import threading
+import os
+
+# Bump when the on-disk layout of the index file changes.
+MGRS_IDX_FORMAT = 1
+MGRS_IDX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mgrs_idx.npz')
+
+TILE_COLUMN = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z']
+TILE_ROW = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'U', 'V']
+
+_mgrs_idx = None
+_mgrs_idx_lock = threading.Lock()
+
+def char_range(c1, c2):
+    """Generates the characters from `c1` to `c2`, inclusive."""
+    for c in range(ord(c1), ord(c2)+1):
+        yield chr(c)
+
+def CalcMGRSIdx():
+    tile_column = TILE_COLUMN
+    tile_row = TILE_ROW
+
+    m = mgrs.MGRS()
+    mgrs_idx = {}
+    for first in range(1, 61):
+        for second in char_range('A', 'Z'):
+            mgrs_idx[(first, second)] = {}
+            tiles = []
+            found_col = []
+            found_row = []
+            for third in tile_column:
+                for fourth in tile_row:
+                    mgrs_str = f'{first}{second}{third}{fourth}'
+                    try:
+                        latlon = m.toLatLon(mgrs_str)
+                        tiles.append((third, fourth))
+                        found_col.append(third)
+                        found_row.append(fourth)
+                    except Exception:
+                        pass
+            low_col = None
+            low_row = None
+            if not tiles:
+                continue
+            if 'Z' not in found_col:
+                low_col = found_col[0]
+            else:
+                gap = False
+                for col in tile_column:
+                    if col not in found_col:
+                        gap = True
+                    else:
+                        if gap:
+                            low_col = col
+                            break
+            if 'Z' not in found_row:
+                low_row = found_row[0]
+            else:
+                gap = False
+                for row in tile_row:
+                    if row not in found_row:
+                        gap = True
+                    else:
+                        if gap:
+                            low_row = row
+                            break
+            for tile in tiles:
+                coffset = ord(tile[0]) - ord(low_col)
+                if coffset < 0:
+                    coffset = coffset + len(tile_column)
+                roffset = ord(tile[1]) - ord(low_row)
+                if roffset < 0:
+                    roffset = roffset + len(tile_row)
+                mgrs_idx[(first, second)][tile] = (coffset, roffset)
+    return(mgrs_idx)
+
+def MGRSVersion():
+    try:
+        from importlib.metadata import version
+        return(version('mgrs'))
+    except Exception:
+        return(getattr(mgrs, '__version__', 'unknown'))
+
+def MGRSIdxToArrays(mgrs_idx):
+    """Flattens a nested MGRS index into parallel uint8 columns, one row per 100km square."""
+    rows = [(first, ord(second), ord(tile[0]), ord(tile[1]), offset[0], offset[1])
+                for (first, second), tiles in mgrs_idx.items()
+                for tile, offset in tiles.items()]
+    table = np.array(rows, dtype=np.uint8).reshape(-1, 6)
+    return({'zone': table[:,0], 'band': table[:,1], 'col': table[:,2], 'row': table[:,3], 'coffset': table[:,4], 'roffset': table[:,5]})
+
+def MGRSIdxFromArrays(arrays):
+    mgrs_idx = {}
+    for first in range(1, 61):
+        for second in char_range('A', 'Z'):
+            mgrs_idx[(first, second)] = {}
+    columns = [arrays[key].tolist() for key in ('zone', 'band', 'col', 'row', 'coffset', 'roffset')]
+    for first, second, third, fourth, coffset, roffset in zip(*columns):
+        mgrs_idx[(first, chr(second))][(chr(third), chr(fourth))] = (coffset, roffset)
+    return(mgrs_idx)
+
+def WriteMGRSIdx(mgrs_idx, path = MGRS_IDX_FILE):
+    arrays = MGRSIdxToArrays(mgrs_idx)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.savez_compressed(file, format=np.array(MGRS_IDX_FORMAT), mgrs_version=np.array(MGRSVersion()), **arrays)
+    os.replace(tmp_path, path)
+
+def ReadMGRSIdx(path = MGRS_IDX_FILE):
+    """Returns the index arrays stored at `path`, or None if the file is missing or was built by a different format or mgrs version."""
+    try:
+        with np.load(path) as data:
+            if int(data['format']) != MGRS_IDX_FORMAT or str(data['mgrs_version']) != MGRSVersion():
+                return(None)
+            return({key: data[key] for key in ('zone', 'band', 'col', 'row', 'coffset', 'roffset')})
+    except (OSError, KeyError, ValueError):
+        return(None)
+
+def MGRSIdxCacheFile():
+    cache_home = os.getenv('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return(os.path.join(cache_home, 'geoquery', 'mgrs_idx.npz'))
+
+class MGRSGrid:
+    """Array view of the MGRS index; a 100km square's tile id is its row in the arrays.
+
+    `zone`, `band`, `col`, `row`, `coffset` and `roffset` are integer arrays
+    (letters as ASCII codes) and `names` holds the tile strings, e.g. '10TES'.
+    """
+    def __init__(self, arrays):
+        self.zone = arrays['zone'].astype(np.int16)
+        self.band = arrays['band'].astype(np.int16)
+        self.col = arrays['col'].astype(np.int16)
+        self.row = arrays['row'].astype(np.int16)
+        self.coffset = arrays['coffset'].astype(np.int16)
+        self.roffset = arrays['roffset'].astype(np.int16)
+        chars = np.stack([self.zone // 10 + ord('0'), self.zone % 10 + ord('0'), self.band, self.col, self.row], axis=1).astype(np.uint8)
+        self.names = chars.view('S5').ravel().astype('U5')
+        key = self.Key(self.zone, self.band, self.col, self.row)
+        self.order = np.argsort(key, kind='stable')
+        self.keys = key[self.order]
+
+    @staticmethod
+    def Key(zone, band, col, row):
+        return(((np.asarray(zone, dtype=np.int64) * 256 + band) * 256 + col) * 256 + row)
+
+    def TileId(self, tile):
+        """Returns the tile id of an MGRS (zone, band, column, row) tuple."""
+        key = self.Key(tile[0], ord(tile[1]), ord(tile[2]), ord(tile[3]))
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(tile)
+        return(int(self.order[i]))
+
+    def Tuples(self, ids):
+        """Returns the (zone, band, column, row) tuples of `ids`."""
+        return([(zone, chr(band), chr(col), chr(row)) for zone, band, col, row in zip(self.zone[ids].tolist(), self.band[ids].tolist(), self.col[ids].tolist(), self.row[ids].tolist())])
+
+    def FindTiles(self, bl, tr):
+        """Returns the ids of the tiles between the `bl` and `tr` MGRS tuples, in zone, band, column, row order.
+
+        Each zone's bands between the corners are one run of the sorted keys,
+        and one search finds the corners and every run. The keys are Python
+        integers, which is faster than numpy for this handful. A box within
+        one zone, the common small query, is then a single slice.
+        """
+        bl_band = ord(bl[1])
+        tr_band = ord(tr[1])
+        corners = [((bl[0] * 256 + bl_band) * 256 + ord(bl[2])) * 256 + ord(bl[3]),
+                   ((tr[0] * 256 + tr_band) * 256 + ord(tr[2])) * 256 + ord(tr[3])]
+        zones = range(bl[0], tr[0] + 1)
+        found = self.keys.searchsorted(corners + [(zone * 256 + bl_band) * 65536 for zone in zones] +
+                                       [(zone * 256 + tr_band + 1) * 65536 for zone in zones]).tolist()
+        for i, key, tile in zip(found, corners, (bl, tr)):
+            if i == len(self.keys) or self.keys[i] != key:
+                raise KeyError(tile)
+        if tr[0] < bl[0]:
+            # Zones are irregular around Svalbard, where a box can end in a lower zone than it starts in.
+            return(np.zeros(0, dtype=self.order.dtype))
+        bl_id = self.order[found[0]]
+        tr_id = self.order[found[1]]
+        lo = found[2:2 + len(zones)]
+        hi = found[2 + len(zones):]
+        if len(zones) == 1:
+            ids = self.order[lo[0]:hi[0]]
+        else:
+            ids = np.concatenate([self.order[l:h] for l, h in zip(lo, hi)])
+        coffset = self.coffset[ids]
+        roffset = self.roffset[ids]
+        if len(zones) == 1:
+            mask = (coffset >= self.coffset[bl_id]) & (coffset <= self.coffset[tr_id])
+        else:
+            zone = self.zone[ids]
+            mask = ~((zone == bl[0]) & (coffset < self.coffset[bl_id]))
+            mask &= ~((zone == tr[0]) & (coffset > self.coffset[tr_id]))
+        if bl_band == tr_band:
+            mask &= (roffset >= self.roffset[bl_id]) & (roffset <= self.roffset[tr_id])
+        else:
+            band = self.band[ids]
+            mask &= ~((band == bl_band) & (roffset < self.roffset[bl_id]))
+            mask &= ~((band == tr_band) & (roffset > self.roffset[tr_id]))
+        # The runs are in key order already, so nothing needs sorting.
+        return(ids[mask])
+
+_mgrs_arrays = None
+_mgrs_grid = None
+
+def GetMGRSArrays():
+    """Returns the MGRS index as arrays, loading it on first use.
+
+    The packaged index is used when it was generated with the installed mgrs
+    version. Otherwise the index is recomputed once and kept in the user cache.
+    """
+    global _mgrs_arrays
+    if _mgrs_arrays is not None:
+        return(_mgrs_arrays)
+    with _mgrs_idx_lock:
+        if _mgrs_arrays is None:
+            arrays = ReadMGRSIdx(MGRS_IDX_FILE)
+            if arrays is None:
+                arrays = ReadMGRSIdx(MGRSIdxCacheFile())
+            if arrays is None:
+                mgrs_idx = CalcMGRSIdx()
+                try:
+                    cache_file = MGRSIdxCacheFile()
+                    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                    WriteMGRSIdx(mgrs_idx, cache_file)
+                except OSError:
+                    pass
+                arrays = MGRSIdxToArrays(mgrs_idx)
+            _mgrs_arrays = arrays
+    return(_mgrs_arrays)
+
+def GetMGRSGrid():
+    global _mgrs_grid
+    if _mgrs_grid is None:
+        _mgrs_grid = MGRSGrid(GetMGRSArrays())
+    return(_mgrs_grid)
+
+def GetMGRSIdx():
+    """Returns the MGRS index as the nested {(zone, band): {(column, row): (coffset, roffset)}} dict built by CalcMGRSIdx()."""
+    global _mgrs_idx
+    if _mgrs_idx is None:
+        _mgrs_idx = MGRSIdxFromArrays(GetMGRSArrays())
+    return(_mgrs_idx)
@@ -0,0 +1,127 @@
+import threading
+import time
+import os
+
+from .Instrumentation import Record as RecordStage
+from .Storage import OpenDatabase
+
+CACHE_POLICIES = ('lru', 'lfu')
+
+class ProjectionCache:
+    """Disk budget for reprojected products.
+
+    Tracks the size, last use and use count of every product passed to Add();
+    Lookup() refreshes the last use of those only. Evict() deletes the least recently ('lru') or least
+    frequently ('lfu') used products until their total size fits in `budget`
+    bytes. Without a budget, lookups record nothing. With one, the uses
+    Lookup() counts are kept in memory and written in one transaction by the
+    next Add() or Evict(). Products used in the last `grace` seconds are never evicted, so
+    running queries keep the files they are reading. `on_evict(path)` is
+    called for each deleted product so in-memory catalogs can drop it.
+    """
+    def __init__(self, path, budget = None, policy = 'lru', on_evict = None, grace = 60):
+        if policy not in CACHE_POLICIES:
+            raise ValueError(f'unknown cache policy: {policy}')
+        self.budget = budget
+        self.policy = policy
+        self.on_evict = on_evict
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        # path -> (last use, uses) since the last flush, and the paths found missing
+        self.used = {}
+        self.missing = set()
+        self.lock = threading.Lock()
+        self.path, self.conn = OpenDatabase(path, self.Setup)
+
+    def Setup(self, conn):
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS products (
+                                path TEXT PRIMARY KEY,
+                                size INTEGER NOT NULL,
+                                last_used REAL NOT NULL,
+                                uses INTEGER NOT NULL)''')
+
+    def Flush(self):
+        """Writes the uses and misses Lookup() counted to the database; the caller holds `lock` in a transaction."""
+        if self.used:
+            self.conn.executemany('UPDATE products SET last_used = ?, uses = uses + ? WHERE path = ?',
+                                  [(last_used, uses, path) for path, (last_used, uses) in self.used.items()])
+            self.used.clear()
+        if self.missing:
+            self.conn.executemany('DELETE FROM products WHERE path = ?', [(path,) for path in self.missing])
+            self.missing.clear()
+
+    def Record(self, path):
+        size = os.path.getsize(path)
+        with self.lock, self.conn:
+            self.Flush()
+            self.conn.execute('''INSERT INTO products VALUES (?, ?, ?, 1)
+                                 ON CONFLICT(path) DO UPDATE SET size = excluded.size, last_used = excluded.last_used, uses = uses + 1''',
+                              (path, size, time.time()))
+
+    def Lookup(self, path):
+        """Returns whether the product at `path` is on disk, counting a hit or a miss.
+
+        A hit refreshes the last use of a product passed to Add(). Other files,
+        such as source data, are never tracked, so they are never evicted.
+        """
+        if path is not None and os.path.exists(path):
+            with self.lock:
+                self.hits += 1
+                if self.budget is not None:
+                    self.used[path] = (time.time(), self.used.get(path, (0, 0))[1] + 1)
+                    self.missing.discard(path)
+            RecordStage('cache', cache_hits = 1)
+            return(True)
+        with self.lock:
+            self.misses += 1
+            if path is not None and self.budget is not None:
+                self.used.pop(path, None)
+                self.missing.add(path)
+        RecordStage('cache', cache_misses = 1)
+        return(False)
+
+    def Add(self, path):
+        """Starts tracking a newly written product."""
+        self.Record(path)
+
+    def Evict(self):
+        """Deletes products until the cache fits its budget, returning the evicted paths."""
+        if self.budget is None:
+            return([])
+        evicted = []
+        order = 'last_used' if self.policy == 'lru' else 'uses, last_used'
+        with self.lock, self.conn:
+            self.Flush()
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM products').fetchone()[0]
+            if total <= self.budget:
+                return([])
+            cutoff = time.time() - self.grace
+            for path, size in self.conn.execute(f'SELECT path, size FROM products WHERE last_used < ? ORDER BY {order}', (cutoff,)).fetchall():
+                if total <= self.budget:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    continue
+                self.conn.execute('DELETE FROM products WHERE path = ?', (path,))
+                total -= size
+                self.evictions += 1
+                self.evicted_bytes += size
+                evicted.append(path)
+        if self.on_evict is not None:
+            for path in evicted:
+                self.on_evict(path)
+        return(evicted)
+
+    def Stats(self):
+        with self.lock, self.conn:
+            self.Flush()
+            files, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM products').fetchone()
+        return({'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'evicted_bytes': self.evicted_bytes,
+                'files': files, 'bytes': size, 'budget': self.budget, 'policy': self.policy})
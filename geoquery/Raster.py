@@ -0,0 +1,279 @@
+from osgeo import gdal,ogr,osr,gdal_array
+import numpy as np
+import threading
+import os
+
+from .Instrumentation import Measure
+from .Storage import AtomicWrite, TempPath
+
+# Thread-local {(source, target): osr.CoordinateTransformation}; OSR transformations must not be shared between threads.
+_transformers = threading.local()
+
+def SpatialRef(projection):
+    """Returns the spatial reference of `projection`: an 'EPSG:<code>' string or anything else SetFromUserInput() accepts, such as WKT or a PROJ string."""
+    srs = osr.SpatialReference()
+    try:
+        err = srs.SetFromUserInput(projection)
+    except RuntimeError:
+        err = 1
+    if err != 0:
+        raise ValueError(f"unsupported projection: {projection}")
+    return(srs)
+
+def GetTransformer(source, target):
+    """Returns the transformation between two projections, created once per thread."""
+    cache = getattr(_transformers, 'cache', None)
+    if cache is None:
+        cache = _transformers.cache = {}
+    if (source, target) not in cache:
+        cache[(source, target)] = osr.CoordinateTransformation(SpatialRef(source), SpatialRef(target))
+    return(cache[(source, target)])
+
+def TransformCoords(lon, lat, projection):
+    """Transforms WGS84 longitudes and latitudes, scalars or arrays of any shape, into `projection`, returning the x and y arrays."""
+    lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    if lon.size == 0:
+        return(np.empty(lon.shape), np.empty(lon.shape))
+    # Points are given as (lat, lon), EPSG:4326's authority axis order.
+    points = np.stack([lat.ravel(), lon.ravel()], axis=1)
+    coords = np.array(GetTransformer('EPSG:4326', projection).TransformPoints(points.tolist()), dtype=np.float64)
+    return(coords[:,0].reshape(lon.shape), coords[:,1].reshape(lon.shape))
+
+def GetSRCoord(lon, lat, projection):
+    x, y = TransformCoords(lon, lat, projection)
+    return((float(x), float(y)))
+
+def WarpToFile(proj_file, measurement, **kwargs):
+    """Warps `measurement` into `proj_file` through a temporary file.
+
+    Concurrent writers of the same product each warp to their own temporary
+    file and atomically rename it, so readers never see a partial GeoTIFF.
+    """
+    with AtomicWrite(proj_file) as tmp_file:
+        dat = gdal.Warp(tmp_file, measurement, format = 'GTiff', **kwargs)
+        if dat is None:
+            raise RuntimeError(f'failed to warp {measurement}: {gdal.GetLastErrorMsg()}')
+        dat = None
+
+def PixelSize(dat, projection):
+    """Returns the size of a pixel at the centre of `dat` in the units of `projection`, e.g. degrees for a geographic one."""
+    geo = dat.GetGeoTransform()
+    x = geo[0] + geo[1] * dat.RasterXSize / 2
+    y = geo[3] + geo[5] * dat.RasterYSize / 2
+    # The dataset's spatial reference takes coordinates in the geotransform's axis order.
+    transformer = osr.CoordinateTransformation(dat.GetSpatialRef(), SpatialRef(projection))
+    coords = np.array(transformer.TransformPoints([(x, y), (x + geo[1], y), (x, y + geo[5])]), dtype=np.float64)[:,:2]
+    return(min(np.hypot(*(coords[1] - coords[0])), np.hypot(*(coords[2] - coords[0]))))
+
+def BuildOverviews(path, projection, resolution, min_size = 64):
+    """Adds external overviews, `<path>.ovr`, to a native product if `resolution` in `projection` is at least twice as coarse as its own.
+
+    Overviews halve the resolution at each level until the smaller side
+    drops below `min_size` pixels. GDAL reads the closest level when a warp
+    or read asks for fewer pixels than the product has. The sidecar is built
+    under a temporary name and renamed into place, so readers in any process
+    never open a partial one. Returns whether the product has overviews.
+    """
+    dat = gdal.Open(path)
+    if dat.GetRasterBand(1).GetOverviewCount() > 0:
+        return(True)
+    if resolution < 2 * PixelSize(dat, projection):
+        return(False)
+    factors = []
+    factor = 2
+    while min(dat.RasterXSize, dat.RasterYSize) // factor >= min_size:
+        factors.append(factor)
+        factor *= 2
+    if not factors:
+        return(False)
+    # GDAL writes the overviews of a read-only dataset to `<dataset>.ovr`, so
+    # they are built for a VRT of the product with a name no other writer uses.
+    vrt = f'{TempPath(path)}.vrt'
+    try:
+        tmp = gdal.BuildVRT(vrt, [path])
+        tmp = None
+        tmp = gdal.Open(vrt)
+        if tmp.BuildOverviews('AVERAGE', factors) != 0:
+            raise RuntimeError(f'failed to build the overviews of {path}: {gdal.GetLastErrorMsg()}')
+        tmp = None
+        os.replace(f'{vrt}.ovr', f'{path}.ovr')
+    finally:
+        tmp = None
+        for tmp_file in (vrt, f'{vrt}.ovr'):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    return(True)
+
+# Creation options of the GeoTIFFs results are written to.
+RESULT_GTIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER']
+
+def WarpWindow(sources, projection, resolution, lb, ub, output = None):
+    """Resamples `sources` straight onto the query grid through an in-memory warped VRT.
+
+    The grid is the one GetSubset() reads: `resolution`-sized pixels with the
+    top-left corner at the lower x of `lb`/`ub` and one pixel above their upper
+    y. Only the pixels of that window are resampled. Returns the array and
+    the nodata value that marks pixels no source covers.
+
+    If `output` is a path, the window is warped into a new GeoTIFF there
+    instead of being read; if it is a dataset from an earlier call, the
+    sources are warped over it where they have data. The dataset is returned
+    in place of the array.
+    """
+    width = int(abs(lb[0] - ub[0]) / resolution)
+    height = int(abs(lb[1] - ub[1]) / resolution)
+    left = min(lb[0], ub[0])
+    top = max(lb[1], ub[1]) + resolution
+    return(WarpGrid(sources, projection, resolution, left, top, width, height, output))
+
+def WarpGrid(sources, projection, resolution, left, top, width, height, output = None):
+    """WarpWindow() onto an explicit grid of `width` by `height` pixels whose top-left corner is (`left`, `top`)."""
+    nodata = gdal.Open(sources[0]).GetRasterBand(1).GetNoDataValue()
+    if nodata is None:
+        nodata = 0
+    if len(sources) > 1:
+        src = gdal.BuildVRT('', sources)
+    else:
+        src = sources[0]
+    with Measure('warp', tiles = len(sources)) as stage:
+        if output is None:
+            vrt = gdal.Warp('', src, format = 'VRT', dstSRS = projection, width = width, height = height,
+                            outputBounds = (left, top - height * resolution, left + width * resolution, top), dstNodata = nodata)
+            arr = vrt.ReadAsArray()
+            stage.Add(bytes_read = arr.nbytes)
+            return(arr, nodata)
+        if isinstance(output, str):
+            output = gdal.Warp(output, src, format = 'GTiff', creationOptions = RESULT_GTIFF_OPTIONS, dstSRS = projection, width = width, height = height,
+                               outputBounds = (left, top - height * resolution, left + width * resolution, top), dstNodata = nodata)
+        else:
+            gdal.Warp(output, src)
+        return(output, nodata)
+
+def RasterType(path):
+    """Returns the numpy dtype of the first band of `path` and its nodata value, 0 if it has none."""
+    band = gdal.Open(path).GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    return(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType), 0 if nodata is None else nodata)
+
+def ReadWindowRows(sources, width, y0, y1, dtype, nodata):
+    """Reads rows [y0, y1) of the query grid from `sources`, (path, offset, size, ret_offset) windows as returned by SubsetWindow()."""
+    rows = np.full((y1 - y0, width), nodata, dtype = dtype)
+    for path, offset, size, ret_offset in sources:
+        first = max(y0, ret_offset[1])
+        last = min(y1, ret_offset[1] + size[1])
+        if size[0] <= 0 or last <= first:
+            continue
+        subset = gdal.Open(path).ReadAsArray(xoff = offset[0], yoff = offset[1] + first - ret_offset[1], xsize = size[0], ysize = last - first)
+        rows[first - y0:last - y0, ret_offset[0]:ret_offset[0] + size[0]] = subset
+    return(rows)
+
+def WarpRows(groups, projection, resolution, left, top, width, y0, y1, dtype, nodata):
+    """Warps rows [y0, y1) of the query grid from `groups`, {projection: [path, ...]}; later groups win where they have data."""
+    rows = np.full((y1 - y0, width), nodata, dtype = dtype)
+    for paths in groups.values():
+        subset, src_nodata = WarpGrid(paths, projection, resolution, left, top - y0 * resolution, width, y1 - y0)
+        valid = subset != src_nodata
+        rows[valid] = subset[valid]
+    return(rows)
+
+def ReadPoints(dat, x, y):
+    """Reads the pixels of `dat` under the points (x, y), given in its projection.
+
+    Points are grouped by the band's blocks and each block holding a point is
+    read once. Returns the indices of the points inside the raster and their
+    values.
+    """
+    geo = dat.GetGeoTransform()
+    band = dat.GetRasterBand(1)
+    col = np.floor((x - geo[0]) / geo[1]).astype(np.int64)
+    row = np.floor((y - geo[3]) / geo[5]).astype(np.int64)
+    inside = np.flatnonzero((col >= 0) & (col < dat.RasterXSize) & (row >= 0) & (row < dat.RasterYSize))
+    col = col[inside]
+    row = row[inside]
+    values = np.empty(len(inside), dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    bw, bh = band.GetBlockSize()
+    blocks = (row // bh) * ((dat.RasterXSize + bw - 1) // bw) + col // bw
+    order = np.argsort(blocks, kind = 'stable')
+    starts = np.flatnonzero(np.diff(blocks[order], prepend = -1))
+    for start, end in zip(starts, np.append(starts[1:], len(order))):
+        points = order[start:end]
+        x0 = int(col[points[0]] // bw * bw)
+        y0 = int(row[points[0]] // bh * bh)
+        block = band.ReadAsArray(x0, y0, min(bw, dat.RasterXSize - x0), min(bh, dat.RasterYSize - y0))
+        values[points] = block[row[points] - y0, col[points] - x0]
+    return(inside, values)
+
+def PolygonMask(rings, left, top, width, height, resolution):
+    """Rasterizes a polygon, given as rings of projected (x, y) vertices with the exterior first, onto a grid; a pixel is inside if its center is."""
+    mem = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Byte)
+    mem.SetGeoTransform((left, resolution, 0, top, 0, -resolution))
+    wkt_rings = []
+    for ring in rings:
+        ring = list(ring)
+        if tuple(ring[0]) != tuple(ring[-1]):
+            ring.append(ring[0])
+        wkt_rings.append('(' + ', '.join(f'{x} {y}' for x, y in ring) + ')')
+    source = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = source.CreateLayer('polygon')
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt(f'POLYGON ({", ".join(wkt_rings)})'))
+    layer.CreateFeature(feature)
+    gdal.RasterizeLayer(mem, [1], layer, burn_values = [1])
+    return(mem.ReadAsArray().astype(bool))
+
+class MosaicWriter:
+    """Assembles a query result into one tiled GeoTIFF per key under `directory` instead of in memory.
+
+    The files cover the same grid as the in-memory result. Copy() moves a
+    window of a source dataset over in strips of `block_size` rows, so memory
+    use depends on the block size, not on the area of interest.
+    """
+    def __init__(self, directory, projection, lb, ub, resolution, fill = 0, block_size = 512):
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+        self.width = int(abs(lb[0] - ub[0]) / resolution)
+        self.height = int(abs(lb[1] - ub[1]) / resolution)
+        self.geotransform = (min(lb[0], ub[0]), resolution, 0, max(lb[1], ub[1]) + resolution, 0, -resolution)
+        self.wkt = SpatialRef(projection).ExportToWkt()
+        self.fill = fill
+        self.block_size = block_size
+        self.datasets = {}
+        self.paths = {}
+
+    def Path(self, key):
+        name = '_'.join(key) if isinstance(key, tuple) else key
+        return(f'{self.directory}/{name}.tif')
+
+    def Dataset(self, key, dtype):
+        if key not in self.datasets:
+            path = self.Path(key)
+            driver = gdal.GetDriverByName('GTiff')
+            dat = driver.Create(path, self.width, self.height, 1, gdal_array.NumericTypeCodeToGDALTypeCode(dtype), RESULT_GTIFF_OPTIONS)
+            dat.SetGeoTransform(self.geotransform)
+            dat.SetProjection(self.wkt)
+            if self.fill != 0 and np.issubdtype(dtype, np.inexact):
+                dat.GetRasterBand(1).Fill(self.fill)
+            self.datasets[key] = dat
+            self.paths[key] = path
+        return(self.datasets[key])
+
+    def Write(self, key, subset, offset):
+        self.Dataset(key, subset.dtype).GetRasterBand(1).WriteArray(subset, offset[0], offset[1])
+
+    def Copy(self, key, dat, offset, size, ret_offset):
+        """Copies the `size` window at `offset` of `dat` to `ret_offset` in the result, strip by strip."""
+        if size[0] <= 0:
+            return
+        with Measure('mosaic', tiles = 1) as stage:
+            for y in range(0, size[1], self.block_size):
+                rows = min(self.block_size, size[1] - y)
+                strip = dat.ReadAsArray(xoff = offset[0], yoff = offset[1] + y, xsize = size[0], ysize = rows)
+                self.Write(key, strip, (ret_offset[0], ret_offset[1] + y))
+                stage.Add(bytes_read = strip.nbytes, bytes_written = strip.nbytes)
+
+    def Close(self):
+        """Flushes the files and returns {key: path}."""
+        for dat in self.datasets.values():
+            dat.FlushCache()
+        self.datasets = {}
+        return(dict(self.paths))
@@ -0,0 +1,336 @@
+from osgeo import gdal
+from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+import numpy as np
+import pickle
+import shutil
+import threading
+import os
+
+from .Catalog import SentinelCatalog
+from .ProjectionCache import ProjectionCache
+from .Download import SentinelHubBackend
+from .Instrumentation import Measure, Bind
+from .Storage import AtomicWrite
+from .Raster import GetSRCoord, WarpToFile, RESULT_GTIFF_OPTIONS, WarpWindow, MosaicWriter
+
+# 'all' extracts whole SAFE archives, 'selected' only the selected measurement
+# files, and 'none' reads the measurements from the archives through /vsizip/.
+SENTINEL_EXTRACT_MODES = ('all', 'selected', 'none')
+
+def SentinelSelection(value):
+    """Parses a `+`-separated band or polarity modifier into a set of lower-case names, or None to select all."""
+    if value is None:
+        return(None)
+    return({name.lower() for name in value.split('+') if name})
+
+class SentinelBoxQuery:
+    def __init__(self, api, target, lon1, lat1, lon2, lat2, sdate, edate):
+        from geojson import Polygon
+        from sentinelsat import geojson_to_wkt
+        self.api = api
+        box = Polygon([[(lon1, lat1), (lon2, lat1), (lon2, lat2), (lon1, lat2), (lon1, lat1)]])
+        self.footprint = geojson_to_wkt(box)
+        self.date = (sdate, edate)
+        self.args = {}
+        try:
+            ignored, argpart = target.split('^')
+            args = argpart.split(',')
+            for arg in args:
+                key, value = arg.split('=')
+                self.args[key] = value
+        except ValueError:
+            pass
+        self.bands = SentinelSelection(self.args.get('band'))
+        self.polarities = SentinelSelection(self.args.get('polarity'))
+        selected = self.bands is not None or self.polarities is not None
+        self.extract = self.args.get('extract', 'selected' if selected else 'all')
+        if self.extract not in SENTINEL_EXTRACT_MODES:
+            raise ValueError(f"unknown extract modifier: {self.extract}")
+
+    def GetProductList(self):
+        products = self.api.query(self.footprint, date=self.date, producttype=self.args['product'], instrumentshortname=self.args['instrument'])
+        self.products = {'products': products, 'bands': self.bands, 'polarities': self.polarities, 'extract': self.extract}
+        return(self.products)
+
+def ImportSentinelDb(catalog, path = '.sentineldb'):
+    """Moves the products recorded in a pickled `.sentineldb` from older versions into `catalog`."""
+    try:
+        with open(path, 'rb') as file:
+            db = pickle.load(file)
+    except FileNotFoundError:
+        return
+    catalog.Import(db)
+    try:
+        os.replace(path, f'{path}.imported')
+    except FileNotFoundError:
+        # Imported concurrently by another process.
+        pass
+
+class SentinelAdapter:
+    def __init__(self, virtual = False, cache_budget = None, cache_policy = 'lru', catalog = '.geoquery_sentinel.sqlite',
+                 backend = None, download_workers = 4, priority = None):
+        self.virtual = virtual
+        self.cache = ProjectionCache('.geoquery_cache.sqlite', cache_budget, cache_policy, self.ForgetProjection)
+        self.lock = threading.RLock()
+        self.fetches = {}
+        # (product, band, polarity, projection, resolution) -> Future of the projection being made
+        self.warps = {}
+        self.download_pool = None
+        self.download_workers = download_workers
+        self.priority = priority
+        # sentinelsat is imported on first use, so HLS-only processes never load it.
+        from sentinelsat import SentinelAPI
+        username = os.getenv('DS_SENTINEL_USERNAME')
+        password = os.getenv('DS_SENTINEL_PWD')
+        self.api = SentinelAPI(username, password, 'https://apihub.copernicus.eu/apihub')
+        self.backend = SentinelHubBackend(self.api) if backend is None else backend
+        self.db = SentinelCatalog(catalog)
+        ImportSentinelDb(self.db)
+
+    def CreateQuery(self, target, lon1, lat1, lon2, lat2, sdate, edate):
+        return(SentinelBoxQuery(self.api, target, lon1, lat1, lon2, lat2, sdate, edate))
+
+    def GetProducts(self, query_results):
+        """Downloads the query's products, then extracts the measurements it selected unless they are read through /vsizip/.
+
+        Up to `download_workers` products are fetched at once, in `priority`
+        order. Each is registered, and its selected measurements extracted,
+        as soon as it arrives, while the others are still downloading.
+        """
+        products = query_results['products']
+        futures = []
+        with self.lock:
+            if self.download_pool is None:
+                self.download_pool = ThreadPoolExecutor(self.download_workers)
+            missing = [product for product in products if product not in self.db]
+            if self.priority is not None:
+                missing.sort(key = lambda product: self.priority(products[product]))
+            for product in missing:
+                # A product that a concurrent query is already fetching is waited on instead of downloaded again.
+                future = self.fetches.get(product)
+                if future is None:
+                    future = self.download_pool.submit(Bind(self.FetchProduct), product, products[product], query_results['extract'])
+                    self.fetches[product] = future
+                    future.add_done_callback(lambda f, product = product: self.ForgetFetch(product))
+                futures.append(future)
+        for product in set(products) - set(missing):
+            self.ExtractSelected(product, query_results)
+        for future in as_completed(futures):
+            self.ExtractSelected(future.result(), query_results)
+
+    def FetchProduct(self, product, metadata, extract):
+        """Downloads `product` with the backend and records its measurements, returning `product`."""
+        zipf = metadata['title']
+        with Measure('download', tiles = 1) as stage:
+            self.backend.Fetch(product, metadata, f'{zipf}.zip')
+            stage.Add(bytes_written = os.path.getsize(f'{zipf}.zip'))
+        with ZipFile(f'{zipf}.zip', 'r') as zip_ref:
+            if extract == 'all':
+                zip_ref.extractall(zipf)
+            measure_dir = f'{zipf}.SAFE/measurement/'
+            members = [name for name in zip_ref.namelist() if name.startswith(measure_dir) and not name.endswith('/')]
+        self.db.AddProduct(product, metadata, [f'{zipf}/{member}' for member in members])
+        return(product)
+
+    def ForgetFetch(self, product):
+        with self.lock:
+            self.fetches.pop(product, None)
+
+    def ExtractSelected(self, product, query_results):
+        if query_results['extract'] != 'none':
+            for measurement in self.SelectMeasurements(product, query_results):
+                if not os.path.exists(measurement):
+                    self.ExtractMeasurement(product, measurement)
+
+    def SelectMeasurements(self, product, query_results):
+        """Returns the paths of the measurements of `product` that the query selected, as /vsizip/ paths if they are not extracted."""
+        title = self.db.Product(product)['product']['title']
+        selected = []
+        for measurement in self.db.Product(product)['measurements']:
+            (band, polarity) = self.GetBandPolarity(measurement)
+            if query_results['bands'] is not None and band.lower() not in query_results['bands']:
+                continue
+            if query_results['polarities'] is not None and polarity.lower() not in query_results['polarities']:
+                continue
+            if query_results['extract'] == 'none':
+                measurement = f'/vsizip/{title}.zip/{os.path.relpath(measurement, title)}'
+            selected.append(measurement)
+        return(selected)
+
+    def ExtractMeasurement(self, product, measurement):
+        """Extracts one measurement file of `product` from its archive, through a temporary file so readers never see part of it."""
+        title = self.db.Product(product)['product']['title']
+        os.makedirs(os.path.dirname(measurement), exist_ok = True)
+        with AtomicWrite(measurement) as tmp_file, Measure('extract', tiles = 1) as stage:
+            with ZipFile(f'{title}.zip', 'r') as zip_ref, zip_ref.open(os.path.relpath(measurement, title)) as src, open(tmp_file, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            stage.Add(bytes_written = os.path.getsize(tmp_file))
+
+    def ProjectMeasurement(self, measurement, projection, resolution):
+        if measurement.startswith('/vsizip/'):
+            # Write next to where the measurement would have been extracted.
+            archive, member = measurement[len('/vsizip/'):].split('.zip/', 1)
+            root_ext = os.path.splitext(f'{archive}/{member}')
+            os.makedirs(os.path.dirname(root_ext[0]), exist_ok = True)
+        else:
+            root_ext = os.path.splitext(measurement)
+        proj_file = f'{root_ext[0]}_{projection}_{resolution}_{root_ext[1]}'
+        with Measure('warp', tiles = 1) as stage:
+            WarpToFile(proj_file, measurement, dstSRS = projection, xRes = resolution, yRes = resolution, creationOptions = RESULT_GTIFF_OPTIONS)
+            stage.Add(bytes_written = os.path.getsize(proj_file))
+        return(proj_file)
+
+    def Project(self, product, measurement, band, polarity, projection, resolution):
+        """Returns the projection of `measurement`, making and recording it unless a usable one exists.
+
+        A projection that another query on this adapter is already making is
+        waited on instead of made again.
+        """
+        key = (product, band, polarity, projection, resolution)
+        with self.lock:
+            future = self.warps.get(key)
+            if future is None:
+                future = Future()
+                self.warps[key] = future
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return(future.result())
+        try:
+            proj_file = self.db.Projection(product, band, polarity, projection, resolution)
+            if not self.cache.Lookup(proj_file):
+                proj_file = self.ProjectMeasurement(measurement, projection, resolution)
+                self.db.AddProjection(product, band, polarity, projection, resolution, proj_file)
+                self.cache.Add(proj_file)
+            future.set_result(proj_file)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.warps.pop(key, None)
+        return(proj_file)
+
+    def GetSubset(self, product, band, polarity, projection, lb, ub, resolution):
+        proj_file = self.db.Projection(product, band, polarity, projection, resolution)
+        dat = gdal.Open(proj_file)
+        offset, size, ret_offset = self.SubsetWindow(product, dat, lb, ub, resolution)
+        if size[0] > 0 and size[1] > 0:
+            with Measure('read', tiles = 1) as stage:
+                arr = dat.ReadAsArray(xoff = offset[0], yoff = offset[1], xsize = size[0], ysize = size[1])
+                stage.Add(bytes_read = arr.nbytes)
+        else:
+            arr = None
+        return arr, ret_offset
+
+    def SubsetWindow(self, product, dat, lb, ub, resolution):
+        if self.db.Product(product)['product']['orbitdirection'] == 'ASCENDING':
+            xres = resolution
+            yres = resolution
+        else:
+            xres = -resolution
+            yres = -resolution
+        tl = (min(lb[0], ub[0]), max(lb[1], ub[1]) + resolution)
+        geo = dat.GetGeoTransform()
+        ret_offset = [0, 0]
+        size = [int(abs(ub[0] - lb[0]) / resolution), int(abs(ub[1] - lb[1]) / resolution)]
+        offset = [int((tl[0] - geo[0]) / xres), int((tl[1] - geo[3]) / yres)]
+        if offset[0] < 0:
+            size[0] = size[0] + offset[0]
+            ret_offset[0] = -offset[0]
+            offset[0] = 0
+        if offset[1] < 0:
+            size[1] = size[1] + offset[1]
+            ret_offset[1] = -offset[1]
+            offset[1] = 0
+        if (offset[0] + size[0]) > dat.RasterXSize:
+            size[0] = dat.GetXSize() - offset[0]
+        if (offset[1] + size[1]) > dat.RasterYSize:
+            size[1] = dat.GetYSize() - offset[1]
+        return(offset, size, ret_offset)
+
+    def ForgetProjection(self, proj_file):
+        self.db.RemoveProjection(proj_file)
+
+    def GetBandPolarity(self, filename):
+        fattrs = os.path.basename(filename).split('-')
+        return((fattrs[3], fattrs[1]))
+
+    def BuildResult(self, products, lon1, lat1, lon2, lat2, projection, resolution, output = None, block_size = 512):
+        """Mosaics the products into one array per (band, polarity) on the query grid.
+
+        With `output`, each one is written to `<output>/<band>_<polarity>.tif`
+        instead, `block_size` rows at a time, and the paths are returned.
+        """
+        lb = GetSRCoord(lon1, lat1, projection)
+        ub = GetSRCoord(lon2, lat2, projection)
+        width = int(abs(lb[0] - ub[0]) / resolution)
+        height = int(abs(lb[1] - ub[1]) / resolution)
+        results = {}
+        if self.virtual:
+            return(self.BuildVirtualResult(products, lb, ub, projection, resolution, output))
+        writer = None if output is None else MosaicWriter(output, projection, lb, ub, resolution, np.nan, block_size)
+        for product in products['products']:
+            for measurement in self.SelectMeasurements(product, products):
+                (band, polarity) = self.GetBandPolarity(measurement)
+                proj_file = self.Project(product, measurement, band, polarity, projection, resolution)
+                if writer is not None:
+                    dat = gdal.Open(proj_file)
+                    writer.Copy((band, polarity), dat, *self.SubsetWindow(product, dat, lb, ub, resolution))
+                    continue
+                subset, offset = self.GetSubset(product, band, polarity, projection, lb, ub, resolution) 
+                if not subset is None:
+                    with Measure('mosaic', bytes_written = subset.nbytes):
+                        if not (band, polarity) in results:
+                            results[(band, polarity)] = np.ndarray((height, width), dtype=subset.dtype)
+                            results[(band, polarity)].fill(np.nan)
+                        results[(band, polarity)][offset[1]:offset[1]+subset.shape[0], offset[0]:offset[0]+subset.shape[1]] = subset
+        self.cache.Evict()
+        if writer is not None:
+            return(writer.Close())
+        return(results)
+
+    def BuildMany(self, queries, projection, resolution):
+        """Fetches and mosaics the products of several queries, downloading and reprojecting each product once.
+
+        `queries` is a list of (products, lon1, lat1, lon2, lat2). Yields
+        (index, results) for each query in turn.
+        """
+        if not queries:
+            return
+        merged = dict(queries[0][0], products = {})
+        for products, lon1, lat1, lon2, lat2 in queries:
+            merged['products'].update(products['products'])
+        with Measure('get_products'):
+            self.GetProducts(merged)
+        for i, (products, lon1, lat1, lon2, lat2) in enumerate(queries):
+            yield(i, self.BuildResult(products, lon1, lat1, lon2, lat2, projection, resolution))
+
+    def BuildVirtualResult(self, products, lb, ub, projection, resolution, output = None):
+        """Warps each measurement straight onto the query grid without writing a projected copy.
+
+        With `output`, GDAL warps into `<output>/<band>_<polarity>.tif` and the paths are returned.
+        """
+        results = {}
+        if output is not None:
+            os.makedirs(output, exist_ok = True)
+        for product in products['products']:
+            for measurement in self.SelectMeasurements(product, products):
+                (band, polarity) = self.GetBandPolarity(measurement)
+                if output is not None:
+                    dat, nodata = WarpWindow([measurement], projection, resolution, lb, ub, results.get((band, polarity), f'{output}/{band}_{polarity}.tif'))
+                    results[(band, polarity)] = dat
+                    continue
+                subset, nodata = WarpWindow([measurement], projection, resolution, lb, ub)
+                if not (band, polarity) in results:
+                    results[(band, polarity)] = np.ndarray(subset.shape, dtype=subset.dtype)
+                    results[(band, polarity)].fill(np.nan)
+                valid = subset != nodata
+                results[(band, polarity)][valid] = subset[valid]
+        if output is not None:
+            for key, dat in results.items():
+                dat.FlushCache()
+                results[key] = f'{output}/{key[0]}_{key[1]}.tif'
+        return(results)
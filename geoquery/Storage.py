@@ -0,0 +1,54 @@
+import contextlib
+import threading
+import sqlite3
+import sys
+import os
+
+# Helpers for the SQLite databases and files that several processes may
+# share, such as the catalogs, the projection cache and written products.
+
+def OpenDatabase(path, setup):
+    """Opens the SQLite database at `path` and calls `setup(conn)` to create its tables.
+
+    File databases use WAL mode, so several processes can read and write
+    them at once. If `path` cannot be opened or written, e.g. in a read-only
+    directory, a warning is printed and an in-memory database is used for the
+    lifetime of the process instead. Returns (path, conn), `path` being
+    ':memory:' after that fallback.
+    """
+    try:
+        return(path, Connect(path, setup))
+    except sqlite3.OperationalError as e:
+        print(f'cannot use {path} ({e}), keeping its data in memory for this process only', file=sys.stderr)
+        return(':memory:', Connect(':memory:', setup))
+
+def Connect(path, setup):
+    conn = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+    try:
+        if path != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+        setup(conn)
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return(conn)
+
+def TempPath(path):
+    """Returns a temporary name next to `path` that no other process or thread writing `path` uses."""
+    return(f'{path}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+@contextlib.contextmanager
+def AtomicWrite(path):
+    """Yields a temporary path to write the content of `path` to, and renames it to `path` when the block succeeds.
+
+    Readers never see a partial file, and concurrent writers of the same
+    path each write their own temporary file. The temporary file is removed
+    if the block fails.
+    """
+    tmp_file = TempPath(path)
+    try:
+        yield(tmp_file)
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
@@ -0,0 +1,120 @@
+import numpy as np
+import warnings
+
+REDUCTIONS = ('latest', 'median', 'max', 'count')
+
+class TimeSeriesCube:
+    """Lazy (time, y, x) stack of one quantity on a query grid.
+
+    `dates` are the acquisition dates along the time axis, in order.
+    `read(t, y0, y1)` returns rows [y0, y1) of the mosaic for date `t`, with
+    `nodata` where no product covers the grid. Nothing is read until the cube
+    is indexed, converted with numpy.asarray(), or reduced. Integer and slice
+    indices on the time and row axes read only the dates and rows they
+    select; other indices load the whole cube first.
+
+    A cube built from reprojected products reads them when it is indexed. If
+    the adapter has a `cache_budget`, another query's eviction may delete
+    products that have not been used for the cache's grace period (60 s by
+    default), after which reading the cube fails. Index or reduce cubes
+    promptly, or build them with `virtual=True`, which reads native products.
+    """
+    def __init__(self, dates, shape, dtype, nodata, read):
+        self.dates = np.array(dates, dtype='datetime64[us]')
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.nodata = nodata
+        self.read = read
+
+    def __len__(self):
+        return(self.shape[0])
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) > 3 or not all(isinstance(k, (int, np.integer, slice)) and not isinstance(k, (bool, np.bool_)) for k in key):
+            return(np.asarray(self)[key])
+        time = key[0]
+        rows = key[1] if len(key) > 1 else slice(None)
+        columns = key[2:]
+        if not isinstance(time, slice):
+            return(self.ReadRows(self.Index(time, 0), rows)[(Ellipsis,) + columns])
+        # Only used for its shape, so nothing is allocated.
+        shape = np.broadcast_to(np.zeros((), dtype = self.dtype), self.shape[1:])[key[1:]].shape
+        times = range(*time.indices(self.shape[0]))
+        result = np.empty((len(times),) + shape, dtype = self.dtype)
+        for i, t in enumerate(times):
+            result[i] = self.ReadRows(t, rows)[(Ellipsis,) + columns]
+        return(result)
+
+    def Index(self, i, axis):
+        size = self.shape[axis]
+        if not -size <= i < size:
+            raise IndexError(f'index {i} is out of bounds for axis {axis} with size {size}')
+        return(int(i) % size)
+
+    def ReadRows(self, t, rows):
+        """Returns row `rows` of date `t`, or the rows a slice selects, reading only the rows they span."""
+        if not isinstance(rows, slice):
+            y = self.Index(rows, 1)
+            return(self.read(t, y, y + 1)[0])
+        ys = range(*rows.indices(self.shape[1]))
+        if not ys:
+            return(np.empty((0, self.shape[2]), dtype = self.dtype))
+        y0 = min(ys)
+        layer = self.read(t, y0, max(ys) + 1)
+        return(layer if ys.step == 1 else layer[np.arange(len(ys)) * ys.step + (ys.start - y0)])
+
+    def __array__(self, dtype = None, copy = None):
+        cube = np.empty(self.shape, dtype = self.dtype)
+        for t in range(self.shape[0]):
+            cube[t] = self.read(t, 0, self.shape[1])
+        return(cube if dtype is None else cube.astype(dtype))
+
+    def Valid(self, layer):
+        valid = layer != self.nodata
+        if np.issubdtype(layer.dtype, np.inexact):
+            valid &= ~np.isnan(layer)
+        return(valid)
+
+    def Reduce(self, reduction, block_size = 512):
+        """Reduces the cube over time, without holding more than one date or strip of rows at once.
+
+        'latest' keeps the last valid value of each pixel, 'max' the largest,
+        and 'count' the number of valid dates. These stream over the dates.
+        'median' is taken over `block_size` rows of every date at a time, as a
+        float array with NaN where no date is valid. Pixels without a valid
+        date are `nodata` for 'latest' and 'max'.
+        """
+        height, width = self.shape[1:]
+        if reduction == 'median':
+            result = np.full((height, width), np.nan)
+            for y0 in range(0, height, block_size):
+                y1 = min(height, y0 + block_size)
+                strip = np.empty((self.shape[0], y1 - y0, width))
+                for t in range(self.shape[0]):
+                    layer = self.read(t, y0, y1)
+                    strip[t] = np.where(self.Valid(layer), layer, np.nan)
+                with warnings.catch_warnings():
+                    # All-NaN pixels are expected and stay NaN.
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    result[y0:y1] = np.nanmedian(strip, axis = 0)
+            return(result)
+        if reduction == 'count':
+            result = np.zeros((height, width), dtype = np.int32)
+        elif reduction in ('latest', 'max'):
+            result = np.full((height, width), self.nodata, dtype = self.dtype)
+            seen = np.zeros((height, width), dtype = bool)
+        else:
+            raise ValueError(f'unknown reduction: {reduction}')
+        for t in range(self.shape[0]):
+            layer = self.read(t, 0, height)
+            valid = self.Valid(layer)
+            if reduction == 'count':
+                result += valid
+            elif reduction == 'latest':
+                result[valid] = layer[valid]
+            else:
+                update = valid & (~seen | (layer > result))
+                result[update] = layer[update]
+                seen |= valid
+        return(result)
@@ -1 +1,21 @@
-from .GeoQuery import GeoInterface, SentinelAdapter, EarthDataAdapter
+import importlib
+
+from .Download import SentinelHubBackend, SentinelMirrorBackend
+from .Instrumentation import AddHook, RemoveHook, JSONExporter
+
+# Public names whose modules import GDAL, numpy and the like. They are loaded
+# when first used, so `import geoquery` stays cheap for processes that only
+# need some of them.
+_lazy = {'GeoInterface': 'GeoQuery', 'EarthDataAdapter': 'EarthData', 'SentinelAdapter': 'Sentinel'}
+
+__all__ = ['GeoInterface', 'EarthDataAdapter', 'SentinelAdapter', 'SentinelHubBackend', 'SentinelMirrorBackend', 'AddHook', 'RemoveHook', 'JSONExporter']
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_lazy[name]}', __name__), name)
+    globals()[name] = value
+    return(value)
+
+def __dir__():
+    return(sorted(set(globals()) | set(_lazy)))
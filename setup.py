@@ -7,5 +7,8 @@ setup(
    author='Philip Davis',
    author_email='philip.davis@sci.utah.edu',
    packages=['geoquery'],
-   install_requires=['wheel', 'osfclient', 'geojson', 'sentinelsat', 'mgrs', 'gdal', 'numpy'],
+   package_data={'geoquery': ['mgrs_idx.npz']},
+   install_requires=['wheel', 'mgrs', 'gdal', 'numpy', 'python-dateutil'],
+   extras_require={'osf': ['osfclient', 'requests'], 'sentinel': ['sentinelsat', 'geojson'], 'all': ['osfclient', 'requests', 'sentinelsat', 'geojson']},
+   entry_points={'console_scripts': ['geoquery-ingest=geoquery.Ingest:Main']},
 )
@@ -0,0 +1,114 @@
+import http.server
+import threading
+import hashlib
+import os
+
+import pytest
+
+from geoquery.Download import FetchURL, DownloadError, SentinelMirrorBackend
+
+# A local stand-in for OSF's file server or a Sentinel mirror: serves `files`
+# by name, honours Range requests, and cuts the connection halfway through
+# the body of the first `drops` responses.
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    def __init__(self, files, drops = 0):
+        super().__init__(('127.0.0.1', 0), FakeHandler)
+        self.files = files
+        self.drops = drops
+        self.ranges = []
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+
+    @property
+    def url(self):
+        return(f'http://127.0.0.1:{self.server_address[1]}')
+
+    def __enter__(self):
+        self.thread.start()
+        return(self)
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = self.server.files.get(self.path.lstrip('/'))
+        if data is None:
+            self.send_error(404)
+            return
+        header = self.headers.get('Range')
+        self.server.ranges.append(header)
+        start = int(header[len('bytes='):].rstrip('-')) if header else 0
+        if start >= len(data):
+            self.send_error(416)
+            return
+        self.send_response(206 if header else 200)
+        if header:
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:]
+        if self.server.drops > 0:
+            self.server.drops -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+DATA = os.urandom(1 << 18)
+
+def test_fetch_resumes_after_a_dropped_connection(tmp_path):
+    tgtfile = str(tmp_path / 'product.tif')
+    with FakeServer({'product.tif': DATA}, drops = 1) as server:
+        FetchURL(f'{server.url}/product.tif', tgtfile, len(DATA), hashlib.md5(DATA).hexdigest(), backoff = 0)
+    assert server.ranges[0] is None
+    # The second request asks only for what the first one did not deliver.
+    assert server.ranges[1] is not None and int(server.ranges[1][len('bytes='):].rstrip('-')) > 0
+    with open(tgtfile, 'rb') as fp:
+        assert fp.read() == DATA
+    assert os.listdir(tmp_path) == ['product.tif']
+
+def test_fetch_rejects_a_wrong_checksum(tmp_path):
+    tgtfile = str(tmp_path / 'product.tif')
+    with FakeServer({'product.tif': DATA}) as server:
+        with pytest.raises(DownloadError):
+            FetchURL(f'{server.url}/product.tif', tgtfile, len(DATA), '0' * 32, retries = 1, backoff = 0)
+    assert len(server.ranges) == 2
+    assert os.listdir(tmp_path) == ['product.tif.part']
+
+class FakeHub:
+    """Stands in for SentinelHubBackend, writing `data` for every product it is asked for."""
+    def __init__(self, data):
+        self.data = data
+        self.fetched = []
+
+    def Fetch(self, product, metadata, path):
+        self.fetched.append(product)
+        with open(path, 'wb') as fp:
+            fp.write(self.data)
+
+def test_mirror_fetches_from_a_url(tmp_path):
+    path = str(tmp_path / 'S1A_TITLE.zip')
+    hub = FakeHub(b'hub')
+    with FakeServer({'S1A_TITLE.zip': DATA}) as server:
+        SentinelMirrorBackend(f'{server.url}/', fallback = hub, backoff = 0).Fetch('product-0', {'title': 'S1A_TITLE'}, path)
+    with open(path, 'rb') as fp:
+        assert fp.read() == DATA
+    assert hub.fetched == []
+
+def test_mirror_falls_back_to_the_hub(tmp_path):
+    path = str(tmp_path / 'S1A_MISSING.zip')
+    hub = FakeHub(b'hub')
+    with FakeServer({'S1A_TITLE.zip': DATA}) as server:
+        with pytest.raises(DownloadError):
+            SentinelMirrorBackend(server.url, retries = 0).Fetch('product-1', {'title': 'S1A_MISSING'}, path)
+        SentinelMirrorBackend(server.url, fallback = hub, retries = 0).Fetch('product-1', {'title': 'S1A_MISSING'}, path)
+    with open(path, 'rb') as fp:
+        assert fp.read() == b'hub'
+    assert hub.fetched == ['product-1']